@@ -1,5 +1,6 @@
 import argparse
 import base64
+import concurrent.futures
 import hashlib
 import hmac
 import json
@@ -15,7 +16,6 @@ import eviltransform
 import gpxpy
 import numpy as np
 import polyline
-import requests
 from config import (
     BASE_TIMEZONE,
     GPX_FOLDER,
@@ -26,6 +26,7 @@ from config import (
     start_point,
 )
 from generator import Generator
+from http_client import RateLimitedSession
 from tzlocal import get_localzone
 from utils import adjust_time_to_utc, adjust_timestamp_to_utc, to_date
 
@@ -71,6 +72,12 @@ TCX_TYPE_DICT = {
 
 # only for running sports, if you want others, please change the True to False
 IS_ONLY_RUN = False
+try:
+    # run records downloaded at the same time
+    CODOON_CONCURRENCY = int(os.getenv("CODOON_CONCURRENCY", "5"))
+except ValueError:
+    print("CODOON_CONCURRENCY is not a number")
+    exit(1)
 
 # If your points need trans from gcj02 to wgs84 coordinate which use by Mapbox
 TRANS_GCJ02_TO_WGS84 = False
@@ -290,7 +297,7 @@ class CodoonAuth:
         self.token = ""
 
         if refresh_token:
-            session = requests.Session()
+            session = RateLimitedSession()
             session.headers.update(device_info_headers())
             query = f"client_id={client_id}&grant_type=refresh_token&refresh_token={refresh_token}&scope=user%2Csports"
             r = session.post(
@@ -366,7 +373,7 @@ class Codoon:
         self.refresh_token = refresh_token
         self.user_id = user_id
 
-        self.session = requests.Session()
+        self.session = RateLimitedSession()
 
         self.session.headers.update(device_info_headers())
 
@@ -401,24 +408,31 @@ class Codoon:
             f"your refresh_token and user_id are {str(self.refresh_token)} {str(self.user_id)}"
         )
 
-    def get_runs_records(self, page=1):
-        payload = {"limit": 500, "page": page, "user_id": self.user_id}
-        r = self.session.post(
-            f"{base_url}/api/get_old_route_log",
-            data=payload,
-            auth=self.auth.reload(payload),
-        )
-        if not r.ok:
-            print(r.json())
-            raise Exception("get runs records error")
+    def iter_runs_records(self, page=1):
+        """Yield the run records page by page, as they are fetched"""
+        while True:
+            payload = {"limit": 500, "page": page, "user_id": self.user_id}
+            r = self.session.post(
+                f"{base_url}/api/get_old_route_log",
+                data=payload,
+                auth=self.auth.reload(payload),
+            )
+            if not r.ok:
+                print(r.json())
+                raise Exception("get runs records error")
+
+            data = r.json()["data"]
+            runs = data["log_list"]
+            if IS_ONLY_RUN:
+                runs = [run for run in runs if run["sports_type"] == 1]
+            print(f"{len(runs)} runs to parse")
+            yield runs
+            if not data["has_more"]:
+                return
+            page += 1
 
-        runs = r.json()["data"]["log_list"]
-        if IS_ONLY_RUN:
-            runs = [run for run in runs if run["sports_type"] == 1]
-        print(f"{len(runs)} runs to parse")
-        if r.json()["data"]["has_more"]:
-            return runs + self.get_runs_records(page + 1)
-        return runs
+    def get_runs_records(self, page=1):
+        return [run for runs in self.iter_runs_records(page) for run in runs]
 
     @staticmethod
     def parse_latlng(points):
@@ -462,10 +476,11 @@ class Codoon:
         payload = {
             "route_id": route_id,
         }
+        # an auth of its own, records are fetched from several threads
         r = self.session.post(
             f"{base_url}/api/get_single_log",
             data=payload,
-            auth=self.auth.reload(payload),
+            auth=CodoonAuth().reload(payload, self.auth.token),
         )
         if not r.ok:
             print(r)
@@ -557,21 +572,38 @@ class Codoon:
         }
         return namedtuple("x", d.keys())(*d.values())
 
-    def get_old_tracks(self, old_ids, with_gpx=False, with_tcx=False):
-        run_records = self.get_runs_records()
-
+    def get_old_tracks(
+        self,
+        old_ids,
+        with_gpx=False,
+        with_tcx=False,
+        stop_at_synced=False,
+        concurrency=CODOON_CONCURRENCY,
+    ):
         old_gpx_ids = os.listdir(GPX_FOLDER)
         old_gpx_ids = [i.split(".")[0] for i in old_gpx_ids if not i.startswith(".")]
-        new_run_routes = [i for i in run_records if str(i["log_id"]) not in old_ids]
         tracks = []
-        for i in new_run_routes:
-            run_data = self.get_single_run_record(i["route_id"])
-            run_data["data"]["id"] = i["log_id"]
-            track = self.parse_raw_data_to_namedtuple(
-                run_data, old_gpx_ids, with_gpx, with_tcx
-            )
-            if track:
-                tracks.append(track)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # records of a page are downloaded while the next page is fetched
+            downloads = []
+            for runs in self.iter_runs_records():
+                new_run_routes = [i for i in runs if str(i["log_id"]) not in old_ids]
+                for i in new_run_routes:
+                    future = executor.submit(self.get_single_run_record, i["route_id"])
+                    downloads.append((i, future))
+                # only when asked for: it takes the log list to be newest first,
+                # which the api does not promise, so older new runs could be missed
+                if runs and not new_run_routes and stop_at_synced:
+                    print("reached runs already synced, stop paging")
+                    break
+            for i, future in downloads:
+                run_data = future.result()
+                run_data["data"]["id"] = i["log_id"]
+                track = self.parse_raw_data_to_namedtuple(
+                    run_data, old_gpx_ids, with_gpx, with_tcx
+                )
+                if track:
+                    tracks.append(track)
         return tracks
 
 
@@ -597,6 +629,20 @@ if __name__ == "__main__":
         action="store_true",
         help="from authorization token for download data",
     )
+    parser.add_argument(
+        "--stop-at-synced",
+        dest="stop_at_synced",
+        action="store_true",
+        help="stop paging at the first page of runs that are all synced, "
+        "assumes codoon lists runs newest first",
+    )
+    parser.add_argument(
+        "--concurrency",
+        dest="concurrency",
+        type=int,
+        default=CODOON_CONCURRENCY,
+        help="number of run records downloaded at the same time",
+    )
     options = parser.parse_args()
     if options.from_refresh_token:
         j = Codoon.from_auth_token(
@@ -612,7 +658,13 @@ if __name__ == "__main__":
 
     generator = Generator(SQL_FILE)
     old_tracks_ids = generator.get_old_tracks_ids()
-    tracks = j.get_old_tracks(old_tracks_ids, options.with_gpx, options.with_tcx)
+    tracks = j.get_old_tracks(
+        old_tracks_ids,
+        options.with_gpx,
+        options.with_tcx,
+        options.stop_at_synced,
+        options.concurrency,
+    )
 
     generator.sync_from_app(tracks)
     activities_list = generator.load()
@@ -19,6 +19,14 @@ FOLDER_DICT = {
 SQL_FILE = os.path.join(parent, "run_page", "data.db")
 JSON_FILE = os.path.join(parent, "src", "static", "activities.json")
 SYNCED_FILE = os.path.join(parent, "imported.json")
+# files only needed to speed up the next run, ignored by git and kept between
+# workflow runs with actions/cache
+CACHE_DIR = os.path.join(parent, ".cache")
+PARSE_CACHE_FILE = os.path.join(CACHE_DIR, "parse_cache.json")
+GEOCODE_CACHE_FILE = os.path.join(CACHE_DIR, "geocode_cache.json")
+FILTER_CACHE_FILE = os.path.join(CACHE_DIR, "filter_cache.json")
+# without it garmin_sync lists the whole history once, so it is only cached
+GARMIN_SYNC_STATE_FILE = os.path.join(CACHE_DIR, "garmin_sync_state.json")
 SYNCED_ACTIVITY_FILE = os.path.join(parent, "synced_activity.json")
 NAME_MAPPING_FILE = os.path.join(FIT_FOLDER, "name_mapping.json")
 
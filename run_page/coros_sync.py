@@ -8,6 +8,7 @@ import aiofiles
 import httpx
 
 from config import JSON_FILE, SQL_FILE, FOLDER_DICT
+from http_client import AsyncHttpClient
 from utils import make_activities_file
 
 COROS_URL_DICT = {
@@ -65,7 +66,7 @@ class Coros:
                 "cookie": f"CPL-coros-region=2; CPL-coros-token={access_token}",
             }
             self.is_only_running = is_only_running
-            self.req = httpx.AsyncClient(timeout=TIME_OUT, headers=self.headers)
+            self.req = AsyncHttpClient(timeout=TIME_OUT, headers=self.headers)
         await client.aclose()
 
     async def init(self):
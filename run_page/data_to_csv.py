@@ -18,8 +18,9 @@ def apply_duration_time(d):
         return ""
 
 
-# we do not need polyline in csv
-df = df.drop("summary_polyline", axis=1)
+# we do not need polyline (only in dbs not migrated to activity_routes yet)
+# and the epoch copy of start_date in csv
+df = df.drop(["summary_polyline", "start_date_epoch"], axis=1, errors="ignore")
 df["elapsed_time"] = df["elapsed_time"].apply(apply_duration_time)
 df["moving_time"] = df["moving_time"].apply(apply_duration_time)
 
@@ -22,4 +22,4 @@ if __name__ == "__main__":
     session = init_db(SQL_FILE)
     add_column_elevation_gain(session)
     # regenerate activities
-    make_activities_file(SQL_FILE, GPX_FOLDER, JSON_FILE)
+    make_activities_file(SQL_FILE, GPX_FOLDER, JSON_FILE, full=True)
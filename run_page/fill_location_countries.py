@@ -0,0 +1,21 @@
+"""
+Resolve location_country of the activities synced without one through
+Nominatim, then regenerate activities.json. Syncs only use the geocode cache
+and the offline dataset (see generator/geocoder.py), run this afterwards.
+"""
+
+from config import GEOCODE_CACHE_FILE, JSON_FILE, SQL_FILE
+from generator import Generator
+from generator.db import fill_location_countries
+from generator.geocoder import GEOCODE_CELL_LEVEL, Geocoder, make_backend
+
+if __name__ == "__main__":
+    generator = Generator(SQL_FILE)
+    geocoder = Geocoder(
+        make_backend("nominatim"), GEOCODE_CACHE_FILE, GEOCODE_CELL_LEVEL
+    )
+    filled = fill_location_countries(generator.session, geocoder)
+    generator.session.commit()
+    print(f"{filled} locations filled")
+    if filled:
+        generator.write_activities_file(JSON_FILE, full=True)
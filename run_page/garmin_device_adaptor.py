@@ -3,7 +3,10 @@ import traceback
 from fit_tool.fit_file import FitFile
 from fit_tool.fit_file_builder import FitFileBuilder
 from fit_tool.profile.messages.device_info_message import DeviceInfoMessage
-from fit_tool.profile.messages.record_message import RecordMessage
+from fit_tool.profile.messages.record_message import (
+    RecordHeartRateField,
+    RecordMessage,
+)
 from io import BytesIO
 
 # the device manufacturer and product info can be found in github,
@@ -70,18 +73,26 @@ def do_process_garmin_data(file_content, use_fake_garmin_device):
     return modified_file.to_bytes()
 
 
-def find_valid_heart_rate(messages, current_index):
-    """Find the nearest valid heart rate value."""
+def is_valid_heart_rate(heart_rate):
+    return heart_rate is not None and heart_rate != 255
 
-    for msg in messages[current_index + 1 :]:
-        if msg.heart_rate is not None and msg.heart_rate != 255:
-            return msg.heart_rate
 
-    for msg in reversed(messages[:current_index]):
-        if msg.heart_rate is not None and msg.heart_rate != 255:
-            return msg.heart_rate
-
-    return None
+def fill_heart_rates(heart_rates):
+    """
+    Replace None/255 with the next valid value, or the last valid value when
+    none follows, in one backward pass.
+    """
+    last_valid = next(
+        (hr for hr in reversed(heart_rates) if is_valid_heart_rate(hr)), None
+    )
+    filled = list(heart_rates)
+    next_valid = None
+    for i in range(len(filled) - 1, -1, -1):
+        if is_valid_heart_rate(filled[i]):
+            next_valid = filled[i]
+        else:
+            filled[i] = next_valid if next_valid is not None else last_valid
+    return filled
 
 
 def create_new_record_message(old_message, heart_rate):
@@ -89,32 +100,40 @@ def create_new_record_message(old_message, heart_rate):
     new_message = RecordMessage()
 
     for field in old_message.fields:
-        field_name = field.name
-        if hasattr(old_message, field_name):
-            field_value = getattr(old_message, field_name)
-            if field_name == "heart_rate":
-                setattr(new_message, field_name, heart_rate)
-            elif field_value is not None:
-                setattr(new_message, field_name, field_value)
+        # fields that are not in the message definition have no value to copy
+        if not field.is_valid() or field.name == "heart_rate":
+            continue
+        field_value = getattr(old_message, field.name, None)
+        if field_value is not None:
+            setattr(new_message, field.name, field_value)
+    new_message.heart_rate = heart_rate
 
     return new_message
 
 
+def is_heart_rate_defined(message):
+    field = message.get_field(RecordHeartRateField.ID)
+    return field is not None and field.is_valid()
+
+
 def get_processed_heart_rate_message(record_messages):
     """Process heart rate data, replacing None/255 values with nearby valid values."""
+    heart_rates = [message.heart_rate for message in record_messages]
     processed_messages = []
 
-    for i, message in enumerate(record_messages):
-        if message.heart_rate is None or message.heart_rate == 255:
-            valid_heart_rate = find_valid_heart_rate(record_messages, i)
-            if valid_heart_rate is not None:
-                processed_messages.append(
-                    create_new_record_message(message, valid_heart_rate)
-                )
-            else:
-                processed_messages.append(message)
-        else:
+    for message, heart_rate, valid_heart_rate in zip(
+        record_messages, heart_rates, fill_heart_rates(heart_rates)
+    ):
+        if is_valid_heart_rate(heart_rate) or valid_heart_rate is None:
             processed_messages.append(message)
+        elif is_heart_rate_defined(message):
+            # the heart rate field is in the message definition, set it in place
+            message.heart_rate = valid_heart_rate
+            processed_messages.append(message)
+        else:
+            processed_messages.append(
+                create_new_record_message(message, valid_heart_rate)
+            )
 
     print("process heart rate data success")
     return processed_messages
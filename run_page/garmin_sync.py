@@ -6,6 +6,8 @@ Copy most code from https://github.com/cyberjunky/python-garminconnect
 import argparse
 import asyncio
 import datetime as dt
+import hashlib
+import json
 import logging
 import os
 import sys
@@ -18,14 +20,21 @@ from lxml import etree
 import aiofiles
 import garth
 import httpx
-from config import FOLDER_DICT, JSON_FILE, SQL_FILE
+from config import FOLDER_DICT, GARMIN_SYNC_STATE_FILE, JSON_FILE, SQL_FILE
 from garmin_device_adaptor import process_garmin_data
+from http_client import AsyncHttpClient
 from utils import make_activities_file_only
 
 # logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 TIME_OUT = httpx.Timeout(240.0, connect=360.0)
+try:
+    # activities synced at the same time, each one fetches its summary and file
+    GARMIN_CONCURRENCY = int(os.getenv("GARMIN_CONCURRENCY", "10"))
+except ValueError:
+    print("GARMIN_CONCURRENCY is not a number")
+    exit(1)
 GARMIN_COM_URL_DICT = {
     "SSO_URL_ORIGIN": "https://sso.garmin.com",
     "SSO_URL": "https://sso.garmin.com/sso",
@@ -50,7 +59,8 @@ class Garmin:
         """
         Init module
         """
-        self.req = httpx.AsyncClient(timeout=TIME_OUT)
+        # pacing, 429 backoff and retries of transient errors are done by the client
+        self.req = AsyncHttpClient(timeout=TIME_OUT)
         self.URL_DICT = (
             GARMIN_CN_URL_DICT
             if auth_domain and str(auth_domain).upper() == "CN"
@@ -73,31 +83,30 @@ class Garmin:
         self.upload_url = self.URL_DICT.get("UPLOAD_URL")
         self.activity_url = self.URL_DICT.get("ACTIVITY_URL")
 
-    async def fetch_data(self, url, retrying=False):
+    async def fetch_data(self, url):
         """
         Fetch and return data
         """
-        try:
-            response = await self.req.get(url, headers=self.headers)
-            if response.status_code == 429:
-                raise GarminConnectTooManyRequestsError("Too many requests")
-            logger.debug(f"fetch_data got response code {response.status_code}")
-            response.raise_for_status()
-            return response.json()
-        except Exception as err:
-            print(err)
-            if retrying:
-                logger.debug(
-                    "Exception occurred during data retrieval, relogin without effect: %s"
-                    % err
-                )
-                raise GarminConnectConnectionError("Error connecting") from err
-            else:
+        for retrying in (False, True):
+            try:
+                response = await self.req.get(url, headers=self.headers)
+                if response.status_code == 429:
+                    raise GarminConnectTooManyRequestsError("Too many requests")
+                logger.debug(f"fetch_data got response code {response.status_code}")
+                response.raise_for_status()
+                return response.json()
+            except Exception as err:
+                print(err)
+                if retrying:
+                    logger.debug(
+                        "Exception occurred during data retrieval, relogin without effect: %s"
+                        % err
+                    )
+                    raise GarminConnectConnectionError("Error connecting") from err
                 logger.debug(
                     "Exception occurred during data retrieval - perhaps session expired - trying relogin: %s"
                     % err
                 )
-                await self.fetch_data(url, retrying=True)
 
     async def get_activities(self, start, limit):
         """
@@ -298,19 +307,82 @@ async def download_garmin_data(
                 else:
                     os.remove(os.path.join(folder, file_info.filename))
             os.remove(file_path)
+        return True
     except Exception as e:
         print(f"Failed to download activity {activity_id}: {str(e)}")
         traceback.print_exc()
+        return False
 
 
-async def get_activity_id_list(client, start=0):
-    activities = await client.get_activities(start, 100)
-    if len(activities) > 0:
-        ids = list(map(lambda a: str(a.get("activityId", "")), activities))
+def load_sync_state():
+    if os.path.exists(GARMIN_SYNC_STATE_FILE):
+        with open(GARMIN_SYNC_STATE_FILE, "r") as f:
+            try:
+                return json.load(f)
+            except Exception as e:
+                print(f"json load {GARMIN_SYNC_STATE_FILE} \nerror {e}")
+    return {}
+
+
+def save_sync_state(state):
+    os.makedirs(os.path.dirname(GARMIN_SYNC_STATE_FILE), exist_ok=True)
+    with open(GARMIN_SYNC_STATE_FILE, "w") as f:
+        json.dump(state, f, indent=2)
+
+
+def activity_mark(activity):
+    """High-water mark of a synced activity, as stored in GARMIN_SYNC_STATE_FILE"""
+    return {
+        "activity_id": str(activity.get("activityId", "")),
+        "start_time": activity.get("startTimeGMT") or "",
+    }
+
+
+def sync_state_key(secret_string, auth_domain, file_type, is_only_running):
+    """Key of a high-water mark in GARMIN_SYNC_STATE_FILE, one per account,
+    the account is told apart by a hash of its secret string"""
+    account = hashlib.sha256(str(secret_string).encode()).hexdigest()[:16]
+    activity_types = "running" if is_only_running else "all"
+    return f"{auth_domain}-{account}-{file_type}-{activity_types}"
+
+
+def reached_mark(activity, mark):
+    if str(activity.get("activityId", "")) == mark["activity_id"]:
+        return True
+    start_time = activity.get("startTimeGMT") or ""
+    # the marked activity may have been deleted since
+    return bool(start_time and mark["start_time"] and start_time <= mark["start_time"])
+
+
+async def get_activity_list(client, stop_at=None, limit=100):
+    """
+    Page through the activity list, newest first.
+    With a high-water mark in stop_at paging stops at the first page that reaches
+    it, without it the whole history is read.
+    Returns the activities and whether the listing completed, a page that
+    still fails after the relogin ends the listing early, the activities
+    listed so far are synced without moving the high-water mark.
+    """
+    activities = []
+    start = 0
+    while True:
+        try:
+            page = await client.get_activities(start, limit)
+        except GarminConnectConnectionError as e:
+            print(f"Failed to list activities from {start}: {e}")
+            return activities, False
+        if not page:
+            return activities, True
         print("Syncing Activity IDs")
-        return ids + await get_activity_id_list(client, start + 100)
-    else:
-        return []
+        activities.extend(page)
+        if stop_at and any(reached_mark(a, stop_at) for a in page):
+            return activities, True
+        start += limit
+
+
+async def get_activity_id_list(client):
+    activities, _ = await get_activity_list(client)
+    return [str(a.get("activityId", "")) for a in activities]
 
 
 async def gather_with_concurrency(n, tasks):
@@ -349,18 +421,36 @@ def get_garmin_summary_infos(activity_summary, activity_id):
 
 
 async def download_new_activities(
-    secret_string, auth_domain, downloaded_ids, is_only_running, folder, file_type
+    secret_string,
+    auth_domain,
+    downloaded_ids,
+    is_only_running,
+    folder,
+    file_type,
+    full_history=False,
+    concurrency=GARMIN_CONCURRENCY,
 ):
     client = Garmin(secret_string, auth_domain, is_only_running)
+    # the activity list is paged newest first and only read down to the newest
+    # activity of the last sync, unless full_history is set
+    sync_state = load_sync_state()
+    state_key = sync_state_key(secret_string, auth_domain, file_type, is_only_running)
+    mark = None if full_history else sync_state.get(state_key)
+    if mark and mark["activity_id"] not in downloaded_ids:
+        # files of the last sync are gone, read the whole history again
+        mark = None
+    activities, listing_complete = await get_activity_list(client, stop_at=mark)
     # because I don't find a para for after time, so I use garmin-id as filename
     # to find new run to generate
-    activity_ids = await get_activity_id_list(client)
+    activity_ids = [str(a.get("activityId", "")) for a in activities]
     to_generate_garmin_ids = list(set(activity_ids) - set(downloaded_ids))
     print(f"{len(to_generate_garmin_ids)} new activities to be downloaded")
 
     to_generate_garmin_id2title = {}
     garmin_summary_infos_dict = {}
-    for id in to_generate_garmin_ids:
+
+    async def sync_activity(id):
+        # summary, then download and write, one pipeline per activity
         try:
             activity_summary = await client.get_activity_summary(id)
             activity_title = activity_summary.get("activityName", "")
@@ -370,20 +460,29 @@ async def download_new_activities(
             )
         except Exception as e:
             print(f"Failed to get activity summary {id}: {str(e)}")
-            continue
+        return await download_garmin_data(
+            client, id, file_type=file_type, summary_infos=garmin_summary_infos_dict
+        )
 
     start_time = time.time()
-    await gather_with_concurrency(
-        10,
-        [
-            download_garmin_data(
-                client, id, file_type=file_type, summary_infos=garmin_summary_infos_dict
-            )
-            for id in to_generate_garmin_ids
-        ],
+    downloaded = await gather_with_concurrency(
+        concurrency, [sync_activity(id) for id in to_generate_garmin_ids]
     )
     print(f"Download finished. Elapsed {time.time()-start_time} seconds")
 
+    # move the mark to the newest activity below every failed download, so the
+    # next run lists the failed ones again
+    failed_ids = {i for i, ok in zip(to_generate_garmin_ids, downloaded) if not ok}
+    if listing_complete:
+        newest_safe_index = max(
+            (index + 1 for index, i in enumerate(activity_ids) if i in failed_ids),
+            default=0,
+        )
+        if newest_safe_index < len(activities):
+            sync_state[state_key] = activity_mark(activities[newest_safe_index])
+            save_sync_state(sync_state)
+
+    print(client.req.metrics.summary())
     await client.req.aclose()
     return to_generate_garmin_ids, to_generate_garmin_id2title
 
@@ -405,6 +504,19 @@ if __name__ == "__main__":
         action="store_true",
         help="if is only for running",
     )
+    parser.add_argument(
+        "--full-history",
+        dest="full_history",
+        action="store_true",
+        help="page through the whole activity history, e.g. to backfill old activities",
+    )
+    parser.add_argument(
+        "--concurrency",
+        dest="concurrency",
+        type=int,
+        default=GARMIN_CONCURRENCY,
+        help="activities downloaded at the same time",
+    )
     parser.add_argument(
         "--tcx",
         dest="download_file_type",
@@ -452,6 +564,8 @@ if __name__ == "__main__":
             is_only_running,
             folder,
             file_type,
+            options.full_history,
+            options.concurrency,
         )
     )
     loop.run_until_complete(future)
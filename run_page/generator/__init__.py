@@ -1,4 +1,5 @@
 import datetime
+import json
 import os
 import sys
 
@@ -10,11 +11,17 @@ from sqlalchemy import func
 
 from polyline_processor import filter_out
 
-from .db import Activity, init_db, update_or_create_activity
+from .db import (
+    UPSERT_CHUNK_SIZE,
+    Activity,
+    bulk_update_or_create_activities,
+    init_db,
+    update_or_create_activity,
+    with_summary_polyline,
+)
 
 from synced_data_file_logger import save_synced_data_file_list
 
-
 IGNORE_BEFORE_SAVING = os.getenv("IGNORE_BEFORE_SAVING", False)
 
 
@@ -27,6 +34,10 @@ class Generator:
         self.client_secret = ""
         self.refresh_token = ""
         self.only_run = False
+        # run_ids upserted since the last write_activities_file
+        self.changed_run_ids = set()
+        # run_id -> start_date_local of the stored activities, see _activity_index
+        self._activity_dates = None
 
     def set_strava_config(self, client_id, client_secret, refresh_token):
         self.client_id = client_id
@@ -57,7 +68,9 @@ class Generator:
         if force:
             filters = {"before": datetime.datetime.utcnow()}
         else:
-            last_activity = self.session.query(func.max(Activity.start_date)).scalar()
+            last_activity = self.session.query(
+                func.max(Activity.start_date_epoch)
+            ).scalar()
             if last_activity:
                 last_activity_date = arrow.get(last_activity)
                 last_activity_date = last_activity_date.shift(days=-7)
@@ -65,6 +78,7 @@ class Generator:
             else:
                 filters = {"before": datetime.datetime.utcnow()}
 
+        activities = []
         for activity in self.client.get_activities(**filters):
             if self.only_run and activity.type != "Run":
                 continue
@@ -77,13 +91,21 @@ class Generator:
             #  strava use total_elevation_gain as elevation_gain
             activity.elevation_gain = activity.total_elevation_gain
             activity.subtype = activity.type
-            created = update_or_create_activity(self.session, activity)
-            if created:
+            activities.append(activity)
+        self._bulk_sync(activities)
+        self.session.commit()
+
+    def _bulk_sync(self, run_activities):
+        """Upsert run_activities in one batch, '+' means new track '.' means update"""
+        created_ids = bulk_update_or_create_activities(self.session, run_activities)
+        for run_activity in run_activities:
+            self.changed_run_ids.add(int(run_activity.id))
+            if int(run_activity.id) in created_ids:
+                self._index_activity(run_activity)
                 sys.stdout.write("+")
             else:
                 sys.stdout.write(".")
-            sys.stdout.flush()
-        self.session.commit()
+        sys.stdout.flush()
 
     def sync_from_data_dir(self, data_dir, file_suffix="gpx", activity_title_dict={}):
         loader = track_loader.TrackLoader()
@@ -96,23 +118,20 @@ class Generator:
             return
 
         synced_files = []
-
         for t in tracks:
-            created = update_or_create_activity(self.session, t.to_namedtuple())
-            if created:
-                sys.stdout.write("+")
-            else:
-                sys.stdout.write(".")
             synced_files.extend(t.file_names)
-            sys.stdout.flush()
 
+        self._bulk_sync([t.to_namedtuple() for t in tracks])
         save_synced_data_file_list(synced_files)
 
         self.session.commit()
 
     def sync_from_kml_track(self, track):
-        created = update_or_create_activity(self.session, track.to_namedtuple())
+        run_activity = track.to_namedtuple()
+        created = update_or_create_activity(self.session, run_activity)
+        self.changed_run_ids.add(int(track.run_id))
         if created:
+            self._index_activity(run_activity)
             sys.stdout.write("+")
         else:
             sys.stdout.write(".")
@@ -125,33 +144,31 @@ class Generator:
             print("No tracks found.")
             return
         print("Syncing tracks '+' means new track '.' means update tracks")
-        synced_files = []
-        for t in app_tracks:
-            created = update_or_create_activity(self.session, t)
-            if created:
-                sys.stdout.write("+")
-            else:
-                sys.stdout.write(".")
-            if "file_names" in t:
-                synced_files.extend(t.file_names)
-            sys.stdout.flush()
-
+        self._bulk_sync(app_tracks)
         self.session.commit()
 
-    def load(self):
+    def _export_query(self, for_mapping=False):
+        """Activities exported to activities.json by load or loadForMapping."""
+        activities = with_summary_polyline(self.session.query(Activity))
+        if for_mapping:
+            return activities.filter(Activity.type.in_(MAPPING_TYPE))
+        activities = activities.filter(Activity.distance > 0.1)
         # if sub_type is not in the db, just add an empty string to it
-        activities = (
-            self.session.query(Activity)
-            .filter(Activity.distance > 0.1)
-            .order_by(Activity.start_date_local)
-        )
+        if self.only_run:
+            activities = activities.filter(Activity.type == "Run")
+        return activities
+
+    @staticmethod
+    def _to_activity_list(
+        activities, filter_polyline, streak=0, last_date=None, polylines=None
+    ):
+        """Convert activities ordered by start_date_local to dicts, continuing
+        the running streak of the activity dated last_date.
+
+        polylines maps run_id to an already exported summary_polyline to reuse.
+        """
         activity_list = []
-
-        streak = 0
-        last_date = None
         for activity in activities:
-            if self.only_run and activity.type != "Run":
-                continue
             # Determine running streak.
             date = datetime.datetime.strptime(
                 activity.start_date_local, "%Y-%m-%d %H:%M:%S"
@@ -167,60 +184,165 @@ class Generator:
                 streak = 1
             activity.streak = streak
             last_date = date
-            if not IGNORE_BEFORE_SAVING:
-                activity.summary_polyline = filter_out(activity.summary_polyline)
-            activity_list.append(activity.to_dict())
+            out = activity.to_dict()
+            if polylines is not None and activity.run_id in polylines:
+                out["summary_polyline"] = polylines[activity.run_id]
+            elif filter_polyline:
+                out["summary_polyline"] = filter_out(activity.summary_polyline)
+            activity_list.append(out)
 
         return activity_list
 
+    def load(self):
+        activities = self._export_query().order_by(Activity.start_date_local)
+        return self._to_activity_list(activities, not IGNORE_BEFORE_SAVING)
+
     def loadForMapping(self):
-        activities = (
-            self.session.query(Activity)
-            .filter(Activity.type.in_(MAPPING_TYPE))
-            .order_by(Activity.start_date_local)
+        activities = self._export_query(for_mapping=True).order_by(
+            Activity.start_date_local
         )
-        activity_list = []
+        return self._to_activity_list(activities, False)
 
-        streak = 0
-        last_date = None
-        for activity in activities:
-            # Determine running streak.
-            # if activity.type == "Run" or activity.type == "Walk":
-            date = datetime.datetime.strptime(
-                activity.start_date_local, "%Y-%m-%d %H:%M:%S"
-            ).date()
-            if last_date is None:
-                streak = 1
-            elif date == last_date:
-                pass
-            elif date == last_date + datetime.timedelta(days=1):
-                streak += 1
-            else:
-                assert date > last_date
-                streak = 1
-            activity.streak = streak
-            last_date = date
-            activity_list.append(activity.to_dict())
+    def write_activities_file(self, json_file, for_mapping=False, full=False):
+        """Write load() (or loadForMapping()) to json_file.
 
-        return activity_list
+        When activities were synced by this generator and json_file was written
+        by this method in the same mode, only the entries from the earliest
+        changed date on are rewritten, everything else is left in place.
+        Otherwise, or with full=True, the whole file is regenerated.
+        """
+        if full or not self._write_activities_file_tail(json_file, for_mapping):
+            activities_list = self.loadForMapping() if for_mapping else self.load()
+            with open(json_file, "w") as f:
+                json.dump(activities_list, f, indent=0)
+        self.changed_run_ids = set()
+
+    def _write_activities_file_tail(self, json_file, for_mapping):
+        """Rewrite json_file from the earliest changed date on, return False
+        if the file can not be updated in place."""
+        # nothing synced here, settings or the db may have changed elsewhere
+        if not os.path.exists(json_file) or not self.changed_run_ids:
+            return False
+
+        changed_ids = list(self.changed_run_ids)
+        changed_dates = []
+        for i in range(0, len(changed_ids), UPSERT_CHUNK_SIZE):
+            changed_dates.extend(
+                r[0]
+                for r in self.session.query(Activity.start_date_local).filter(
+                    Activity.run_id.in_(changed_ids[i : i + UPSERT_CHUNK_SIZE])
+                )
+            )
+        if not changed_dates:
+            return False
+        # streaks only depend on earlier days, so start at the changed day
+        cut_date = min(changed_dates)[:10]
+
+        activities = self._export_query(for_mapping)
+        previous = (
+            activities.filter(Activity.start_date_local < cut_date)
+            .order_by(Activity.start_date_local.desc())
+            .first()
+        )
+        if previous is None:
+            return False
+
+        with open(json_file, "rb") as f:
+            text = f.read().decode("ascii", errors="replace")
+        # the layout written by json.dump(..., indent=0): one key per line,
+        # objects starting with run_id and ending with a single "}" line
+        start = text.find(f'{{\n"run_id": {previous.run_id},\n')
+        end = text.find("\n}", start) + 2
+        if (
+            start < 0
+            or end < 2
+            or not text.startswith("[\n{")
+            or not text.endswith("\n]")
+        ):
+            return False
+        tail = text[end:-2]
+        try:
+            previous_dict = json.loads(text[start:end])
+            old_tail = json.loads("[" + tail[1:] + "]") if tail else []
+        except ValueError:
+            return False
+        if "streak" not in previous_dict or any(
+            a["start_date_local"] < cut_date for a in old_tail
+        ):
+            return False
+        filter_polyline = not for_mapping and not IGNORE_BEFORE_SAVING
+        # the kept head must be what this mode and these settings export: the
+        # same number of activities and the same last one before cut_date
+        head_count = text.count('{\n"run_id": ', 0, start) + 1
+        if head_count != activities.filter(
+            Activity.start_date_local < cut_date
+        ).count() or not self._same_activity(previous_dict, previous, filter_polyline):
+            return False
+
+        polylines = {
+            a["run_id"]: a["summary_polyline"]
+            for a in old_tail
+            if a["run_id"] not in self.changed_run_ids
+        }
+        new_tail = self._to_activity_list(
+            activities.filter(Activity.start_date_local >= cut_date).order_by(
+                Activity.start_date_local
+            ),
+            filter_polyline,
+            previous_dict["streak"],
+            datetime.datetime.strptime(
+                previous.start_date_local, "%Y-%m-%d %H:%M:%S"
+            ).date(),
+            polylines,
+        )
+        with open(json_file, "r+b") as f:
+            f.seek(end)
+            for a in new_tail:
+                f.write((",\n" + json.dumps(a, indent=0)).encode("ascii"))
+            f.write(b"\n]")
+            f.truncate()
+        print(f"Rewrote {len(new_tail)} activities from {cut_date} on")
+        return True
+
+    def _same_activity(self, activity_dict, activity, filter_polyline):
+        """Whether activity_dict read from the file is activity as exported
+        now, apart from the streak."""
+        (expected,) = self._to_activity_list([activity], filter_polyline)
+        expected = json.loads(json.dumps(expected))
+        expected.pop("streak", None)
+        return expected == {k: v for k, v in activity_dict.items() if k != "streak"}
+
+    def _activity_index(self):
+        """run_id -> start_date_local of every stored activity.
+
+        Read with a single column query on first use and kept up to date by the
+        sync methods, so the sync modules can check what is already synced
+        without loading the activities.
+        """
+        if self._activity_dates is None:
+            self._activity_dates = dict(
+                self.session.query(Activity.run_id, Activity.start_date_local)
+            )
+        return self._activity_dates
+
+    def _index_activity(self, run_activity):
+        # only new activities, start_date_local is not updated on later syncs
+        if self._activity_dates is not None:
+            self._activity_dates[int(run_activity.id)] = run_activity.start_date_local
 
     def get_old_tracks_ids(self):
+        """Set of the stored run_ids as strings."""
         try:
-            activities = self.session.query(Activity).all()
-            return [str(a.run_id) for a in activities]
+            return {str(run_id) for run_id in self._activity_index()}
         except Exception as e:
             # pass the error
             print(f"something wrong with {str(e)}")
-            return []
+            return set()
 
     def get_old_tracks_dates(self):
+        """start_date_local of the stored activities, newest first."""
         try:
-            activities = (
-                self.session.query(Activity)
-                .order_by(Activity.start_date_local.desc())
-                .all()
-            )
-            return [str(a.start_date_local) for a in activities]
+            return sorted(map(str, self._activity_index().values()), reverse=True)
         except Exception as e:
             # pass the error
             print(f"something wrong with {str(e)}")
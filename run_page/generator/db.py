@@ -1,35 +1,31 @@
+import atexit
+import calendar
 import datetime
-import random
-import string
 
-import geopy
+import polyline
 from config import TYPE_DICT
-from geopy.geocoders import Nominatim
 from sqlalchemy import (
     Column,
     Float,
+    ForeignKey,
     Integer,
     Interval,
     String,
     create_engine,
+    event,
     inspect,
+    or_,
     text,
+    update,
 )
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import query_expression, sessionmaker, with_expression
 
-Base = declarative_base()
-
-
-# random user name 8 letters
-def randomword():
-    letters = string.ascii_lowercase
-    return "".join(random.choice(letters) for i in range(4))
+from .geocoder import get_geocoder
 
-
-geopy.geocoders.options.default_user_agent = "my-application"
-# reverse the location (lat, lon) -> location detail
-g = Nominatim(user_agent=randomword())
+Base = declarative_base()
 
 
 ACTIVITY_KEYS = [
@@ -49,6 +45,16 @@ ACTIVITY_KEYS = [
 ]
 
 
+class ActivityRoute(Base):
+    """Route of an activity, kept out of the activities rows so that
+    queries on the summary columns do not read the polylines."""
+
+    __tablename__ = "activity_routes"
+
+    run_id = Column(Integer, ForeignKey("activities.run_id"), primary_key=True)
+    summary_polyline = Column(String)
+
+
 class Activity(Base):
     __tablename__ = "activities"
 
@@ -57,16 +63,23 @@ class Activity(Base):
     distance = Column(Float)
     moving_time = Column(Interval)
     elapsed_time = Column(Interval)
-    type = Column(String)
-    start_date = Column(String)
-    start_date_local = Column(String)
+    type = Column(String, index=True)
+    start_date = Column(String, index=True)
+    start_date_local = Column(String, index=True)
+    # start_date as unix seconds, filled for existing rows when the column is added
+    start_date_epoch = Column(
+        Integer,
+        index=True,
+        info={"backfill": "CAST(strftime('%s', substr(start_date, 1, 19)) AS INTEGER)"},
+    )
     location_country = Column(String)
-    summary_polyline = Column(String)
     average_heartrate = Column(Float)
     average_speed = Column(Float)
     elevation_gain = Column(Float)
     streak = None
-    source = Column(String)
+    source = Column(String, index=True)
+    # None unless the query was passed through with_summary_polyline
+    summary_polyline = query_expression()
 
     def to_dict(self):
         out = {}
@@ -83,87 +96,178 @@ class Activity(Base):
         return out
 
 
+# activities joined with their routes, the columns of the table before the routes
+# were moved out, for tools that read the db directly
+ACTIVITIES_VIEW = "activities_with_polyline"
+
+# rows per executemany / IN (...) batch, well below the sqlite variable limit
+UPSERT_CHUNK_SIZE = 500
+
+# columns kept from the first import when an activity is synced again
+INSERT_ONLY_KEYS = [
+    "run_id",
+    "start_date",
+    "start_date_local",
+    "start_date_epoch",
+    "location_country",
+]
+
+# applied to every new connection, WAL lets the readers run next to a sync.
+# journal_mode is stored in the db file, close_db switches it back to DELETE
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "cache_size": -16000,  # KiB
+}
+
+
+def date_to_epoch(value):
+    """Unix seconds of a stored date, its first 19 characters taken as UTC
+    like the backfill of start_date_epoch, None if it cannot be parsed."""
+    if not value:
+        return None
+    try:
+        date = datetime.datetime.strptime(
+            str(value)[:19].replace("T", " "), "%Y-%m-%d %H:%M:%S"
+        )
+    except ValueError:
+        return None
+    return calendar.timegm(date.timetuple())
+
+
+def needs_location_lookup(run_activity):
+    location_country = getattr(run_activity, "location_country", "")
+    # or China for #176 to fix
+    return bool(
+        run_activity.start_latlng
+        and (not location_country or location_country == "China")
+    )
+
+
+def resolve_location_countries(run_activities):
+    """Return location_country for each activity, reverse geocoding the start
+    points that need it in one batch through the cached geocoder."""
+    locations = [getattr(a, "location_country", "") for a in run_activities]
+    lookups = [i for i, a in enumerate(run_activities) if needs_location_lookup(a)]
+    if lookups:
+        points = [
+            (run_activities[i].start_latlng.lat, run_activities[i].start_latlng.lon)
+            for i in lookups
+        ]
+        for i, location in zip(lookups, get_geocoder().reverse_many(points)):
+            if location:
+                locations[i] = location
+    return locations
+
+
+def fill_location_countries(session, geocoder):
+    """Resolve location_country of the stored activities that have none yet
+    (or only "China", see needs_location_lookup) from the first point of their
+    route, and return how many were filled. The caller commits."""
+    rows = (
+        session.query(Activity.run_id, ActivityRoute.summary_polyline)
+        .join(ActivityRoute)
+        .filter(
+            or_(
+                Activity.location_country.is_(None),
+                Activity.location_country.in_(["", "China"]),
+            ),
+            ActivityRoute.summary_polyline != "",
+        )
+        .all()
+    )
+    starts = []
+    for run_id, summary_polyline in rows:
+        try:
+            points = polyline.decode(summary_polyline)
+        except Exception:
+            continue
+        if points:
+            starts.append((run_id, points[0]))
+    locations = geocoder.reverse_many([point for _, point in starts])
+    updates = [
+        {"run_id": run_id, "location_country": location}
+        for (run_id, _), location in zip(starts, locations)
+        if location
+    ]
+    if updates:
+        session.execute(update(Activity), updates)
+    return len(updates)
+
+
+def get_activity_values(run_activity):
+    """Return the column values of the activities row for run_activity,
+    without location_country which is only resolved for new rows."""
+    type = run_activity.type
+    source = run_activity.source if hasattr(run_activity, "source") else "gpx"
+    if run_activity.type in TYPE_DICT:
+        type = TYPE_DICT[run_activity.type]
+
+    current_elevation_gain = 0.0  # default value
+
+    # https://github.com/stravalib/stravalib/blob/main/src/stravalib/strava_model.py#L639C1-L643C41
+    if (
+        hasattr(run_activity, "total_elevation_gain")
+        and run_activity.total_elevation_gain is not None
+    ):
+        current_elevation_gain = float(run_activity.total_elevation_gain)
+    elif (
+        hasattr(run_activity, "elevation_gain")
+        and run_activity.elevation_gain is not None
+    ):
+        current_elevation_gain = float(run_activity.elevation_gain)
+
+    return {
+        "run_id": int(run_activity.id),
+        "name": run_activity.name,
+        "distance": float(run_activity.distance),
+        "moving_time": run_activity.moving_time,
+        "elapsed_time": run_activity.elapsed_time,
+        "type": type,
+        "start_date": run_activity.start_date,
+        "start_date_local": run_activity.start_date_local,
+        "start_date_epoch": date_to_epoch(run_activity.start_date),
+        "average_heartrate": run_activity.average_heartrate,
+        "average_speed": float(run_activity.average_speed),
+        "elevation_gain": current_elevation_gain,
+        "summary_polyline": (
+            run_activity.map and run_activity.map.summary_polyline or ""
+        ),
+        "source": source,
+    }
+
+
+def with_summary_polyline(query):
+    """Load the routes of the Activity rows of query into summary_polyline."""
+    return query.outerjoin(ActivityRoute).options(
+        with_expression(Activity.summary_polyline, ActivityRoute.summary_polyline)
+    )
+
+
 def update_or_create_activity(session, run_activity):
     created = False
     try:
         activity = (
             session.query(Activity).filter_by(run_id=int(run_activity.id)).first()
         )
-        type = run_activity.type
-        source = run_activity.source if hasattr(run_activity, "source") else "gpx"
-        if run_activity.type in TYPE_DICT:
-            type = TYPE_DICT[run_activity.type]
-
-        current_elevation_gain = 0.0  # default value
-
-        # https://github.com/stravalib/stravalib/blob/main/src/stravalib/strava_model.py#L639C1-L643C41
-        if (
-            hasattr(run_activity, "total_elevation_gain")
-            and run_activity.total_elevation_gain is not None
-        ):
-            current_elevation_gain = float(run_activity.total_elevation_gain)
-        elif (
-            hasattr(run_activity, "elevation_gain")
-            and run_activity.elevation_gain is not None
-        ):
-            current_elevation_gain = float(run_activity.elevation_gain)
+        values = get_activity_values(run_activity)
+        session.merge(
+            ActivityRoute(
+                run_id=values["run_id"],
+                summary_polyline=values.pop("summary_polyline"),
+            )
+        )
 
         if not activity:
-            start_point = run_activity.start_latlng
-            location_country = getattr(run_activity, "location_country", "")
-            # or China for #176 to fix
-            if not location_country and start_point or location_country == "China":
-                try:
-                    location_country = str(
-                        g.reverse(
-                            f"{start_point.lat}, {start_point.lon}", language="zh-CN"
-                        )
-                    )
-                # limit (only for the first time)
-                except Exception:
-                    try:
-                        location_country = str(
-                            g.reverse(
-                                f"{start_point.lat}, {start_point.lon}",
-                                language="zh-CN",
-                            )
-                        )
-                    except Exception:
-                        pass
-
-            activity = Activity(
-                run_id=run_activity.id,
-                name=run_activity.name,
-                distance=run_activity.distance,
-                moving_time=run_activity.moving_time,
-                elapsed_time=run_activity.elapsed_time,
-                type=type,
-                start_date=run_activity.start_date,
-                start_date_local=run_activity.start_date_local,
-                location_country=location_country,
-                average_heartrate=run_activity.average_heartrate,
-                average_speed=float(run_activity.average_speed),
-                elevation_gain=current_elevation_gain,
-                summary_polyline=(
-                    run_activity.map and run_activity.map.summary_polyline or ""
-                ),
-                source=source,
-            )
+            (location_country,) = resolve_location_countries([run_activity])
+            activity = Activity(location_country=location_country, **values)
             session.add(activity)
             created = True
         else:
-            activity.name = run_activity.name
-            activity.distance = float(run_activity.distance)
-            activity.moving_time = run_activity.moving_time
-            activity.elapsed_time = run_activity.elapsed_time
-            activity.type = type
-            activity.average_heartrate = run_activity.average_heartrate
-            activity.average_speed = float(run_activity.average_speed)
-            activity.elevation_gain = current_elevation_gain
-            activity.summary_polyline = (
-                run_activity.map and run_activity.map.summary_polyline or ""
-            )
-            activity.source = source
+            for key, value in values.items():
+                if key not in INSERT_ONLY_KEYS:
+                    setattr(activity, key, value)
     except Exception as e:
         print(f"something wrong with {run_activity.id}")
         print(str(e))
@@ -171,6 +275,73 @@ def update_or_create_activity(session, run_activity):
     return created
 
 
+def get_existing_run_ids(session, run_ids):
+    """Return the subset of run_ids already stored, one query per chunk."""
+    run_ids = list(run_ids)
+    existing = set()
+    for i in range(0, len(run_ids), UPSERT_CHUNK_SIZE):
+        chunk = run_ids[i : i + UPSERT_CHUNK_SIZE]
+        existing.update(
+            r[0]
+            for r in session.query(Activity.run_id).filter(Activity.run_id.in_(chunk))
+        )
+    return existing
+
+
+def bulk_update_or_create_activities(session, run_activities):
+    """Upsert a batch of activities and return the set of newly created run_ids.
+
+    Existing run_ids are fetched up front, then all rows are written with
+    INSERT ... ON CONFLICT DO UPDATE in chunked executemany calls, which keeps
+    the update semantics of update_or_create_activity.
+    """
+    rows = []
+    for run_activity in run_activities:
+        try:
+            rows.append((run_activity, get_activity_values(run_activity)))
+        except Exception as e:
+            print(f"something wrong with {run_activity.id}")
+            print(str(e))
+    existing_ids = get_existing_run_ids(session, {v["run_id"] for _, v in rows})
+
+    created_ids = set()
+    new_rows = []
+    for run_activity, values in rows:
+        run_id = values["run_id"]
+        # ignored on conflict, only used when the row is inserted
+        values["location_country"] = ""
+        if run_id not in existing_ids and run_id not in created_ids:
+            new_rows.append((run_activity, values))
+            created_ids.add(run_id)
+    locations = resolve_location_countries([a for a, _ in new_rows])
+    for (_, values), location_country in zip(new_rows, locations):
+        values["location_country"] = location_country
+    rows = [values for _, values in rows]
+    if not rows:
+        return created_ids
+    route_rows = [
+        {"run_id": values["run_id"], "summary_polyline": values.pop("summary_polyline")}
+        for values in rows
+    ]
+
+    stmt = sqlite_insert(Activity.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Activity.run_id],
+        set_={
+            key: stmt.excluded[key] for key in rows[0] if key not in INSERT_ONLY_KEYS
+        },
+    )
+    route_stmt = sqlite_insert(ActivityRoute.__table__)
+    route_stmt = route_stmt.on_conflict_do_update(
+        index_elements=[ActivityRoute.run_id],
+        set_={"summary_polyline": route_stmt.excluded.summary_polyline},
+    )
+    for i in range(0, len(rows), UPSERT_CHUNK_SIZE):
+        session.execute(stmt, rows[i : i + UPSERT_CHUNK_SIZE])
+        session.execute(route_stmt, route_rows[i : i + UPSERT_CHUNK_SIZE])
+    return created_ids
+
+
 def add_missing_columns(engine, model):
     inspector = inspect(engine)
     table_name = model.__tablename__
@@ -181,7 +352,7 @@ def add_missing_columns(engine, model):
         if column.name not in columns:
             missing_columns.append(column)
     if missing_columns:
-        with engine.connect() as conn:
+        with engine.begin() as conn:
             for column in missing_columns:
                 column_type = str(column.type)
                 conn.execute(
@@ -189,19 +360,95 @@ def add_missing_columns(engine, model):
                         f"ALTER TABLE {table_name} ADD COLUMN {column.name} {column_type}"
                     )
                 )
+                # derived columns are computed for the rows already stored
+                backfill = column.info.get("backfill")
+                if backfill:
+                    conn.execute(
+                        text(f"UPDATE {table_name} SET {column.name} = {backfill}")
+                    )
+
+
+def move_summary_polylines(engine):
+    """Move summary_polyline of a db written before activity_routes existed
+    to that table, then drop the column and give the space back."""
+    columns = {col["name"] for col in inspect(engine).get_columns("activities")}
+    if "summary_polyline" not in columns:
+        return
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "INSERT OR REPLACE INTO activity_routes (run_id, summary_polyline) "
+                "SELECT run_id, summary_polyline FROM activities"
+            )
+        )
+        conn.execute(text("ALTER TABLE activities DROP COLUMN summary_polyline"))
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("VACUUM"))
+
+
+def create_activities_view(engine):
+    # recreated every time so it follows the columns added to activities,
+    # summary_polyline stays where it was in the table
+    columns = []
+    for col in inspect(engine).get_columns("activities"):
+        columns.append(f"activities.{col['name']}")
+        if col["name"] == "location_country":
+            columns.append("activity_routes.summary_polyline")
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP VIEW IF EXISTS {ACTIVITIES_VIEW}"))
+        conn.execute(
+            text(
+                f"CREATE VIEW {ACTIVITIES_VIEW} AS SELECT {', '.join(columns)} "
+                "FROM activities LEFT JOIN activity_routes USING (run_id)"
+            )
+        )
+
+
+def add_missing_indexes(engine, model):
+    # create_all only creates the indexes of new tables
+    for index in model.__table__.indexes:
+        index.create(engine, checkfirst=True)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+def close_db(session):
+    """Write the WAL back into the db file and leave it in rollback journal mode,
+    data.db is committed by the sync workflows without -wal or -shm files."""
+    engine = session.get_bind()
+    session.close()
+    engine.dispose()
+    try:
+        with engine.connect() as conn:
+            conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.exec_driver_sql("PRAGMA journal_mode=DELETE")
+    except OperationalError:
+        # another connection of this process is still open, its close_db does it
+        pass
+    engine.dispose()
 
 
 def init_db(db_path):
     engine = create_engine(
         f"sqlite:///{db_path}", connect_args={"check_same_thread": False}
     )
+    event.listen(engine, "connect", set_sqlite_pragmas)
     Base.metadata.create_all(engine)
 
+    move_summary_polylines(engine)
     # check missing columns
     add_missing_columns(engine, Activity)
+    add_missing_indexes(engine, Activity)
+    create_activities_view(engine)
 
     sm = sessionmaker(bind=engine)
     session = sm()
     # apply the changes
     session.commit()
+    atexit.register(close_db, session)
     return session
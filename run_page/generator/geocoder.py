@@ -0,0 +1,183 @@
+"""Reverse geocoding of activity start points, cached per S2 cell.
+
+GEOCODE_BACKEND picks the backend that resolves cells missing from the cache:
+"offline" looks up the nearest place in the GEOCODE_OFFLINE_FILE dataset,
+"nominatim" asks the live service during the sync and "none" only uses the
+cache. "auto", the default, is "offline" when GEOCODE_OFFLINE_FILE is set and
+"none" otherwise, so syncs never wait on the network: activities in cells that
+are not cached are stored with an empty location_country and
+fill_location_countries.py resolves them through Nominatim later.
+"""
+
+import json
+import os
+import random
+import string
+
+import geopy
+import numpy as np
+import s2sphere as s2
+from config import GEOCODE_CACHE_FILE
+from geopy.geocoders import Nominatim
+
+GEOCODE_BACKEND = os.getenv("GEOCODE_BACKEND", "auto")
+GEOCODE_OFFLINE_FILE = os.getenv("GEOCODE_OFFLINE_FILE", "")
+
+
+def _env_number(name, default, convert):
+    # a bad value must not stop the scripts that only import generator.db
+    value = os.getenv(name, default)
+    try:
+        return convert(value)
+    except ValueError:
+        print(f"{name}={value} is not a number, using {default}")
+        return convert(default)
+
+
+# level 13 cells are about 1 km wide, every start point in one cell shares a location
+GEOCODE_CELL_LEVEL = _env_number("GEOCODE_CELL_LEVEL", "13", int)
+# offline places further away than this (km) are not used
+GEOCODE_OFFLINE_MAX_DISTANCE = _env_number("GEOCODE_OFFLINE_MAX_DISTANCE", "50", float)
+
+EARTH_RADIUS = 6371.0088  # km, same as haversine
+
+
+# random user name 8 letters
+def randomword():
+    letters = string.ascii_lowercase
+    return "".join(random.choice(letters) for i in range(4))
+
+
+class NominatimBackend:
+    """Live lookups against OpenStreetMap Nominatim, retried once."""
+
+    def __init__(self):
+        geopy.geocoders.options.default_user_agent = "my-application"
+        self.g = Nominatim(user_agent=randomword())
+
+    def reverse(self, lat, lon):
+        for _ in range(2):
+            try:
+                location = self.g.reverse(f"{lat}, {lon}", language="zh-CN")
+                return str(location) if location else None
+            # limit (only for the first time)
+            except Exception:
+                pass
+        return None
+
+
+class OfflineBackend:
+    """Nearest place from a local dataset.
+
+    The dataset is a JSON list of {"lat": .., "lon": .., "location": ..}, where
+    location is stored as is, e.g. "浦东新区, 上海市, 中国".
+    """
+
+    def __init__(self, dataset_file, max_distance=GEOCODE_OFFLINE_MAX_DISTANCE):
+        with open(dataset_file, "r", encoding="utf-8") as f:
+            places = json.load(f)
+        self.locations = [p["location"] for p in places]
+        coords = np.radians(np.array([[p["lat"], p["lon"]] for p in places], float))
+        self.lat = coords[:, 0] if places else np.empty(0)
+        self.lon = coords[:, 1] if places else np.empty(0)
+        self.max_distance = max_distance
+
+    def reverse(self, lat, lon):
+        if not self.locations:
+            return None
+        lat, lon = np.radians(lat), np.radians(lon)
+        a = (
+            np.sin((self.lat - lat) / 2) ** 2
+            + np.cos(lat) * np.cos(self.lat) * np.sin((self.lon - lon) / 2) ** 2
+        )
+        distances = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+        index = int(np.argmin(distances))
+        if distances[index] > self.max_distance:
+            return None
+        return self.locations[index]
+
+
+class Geocoder:
+    """Resolve start points to location strings through a persistent cell cache.
+
+    Points are quantised to S2 cells at `level` and the backend is only asked
+    about cells that are not cached yet. Cells the backend cannot resolve are
+    not cached and are retried on the next run.
+
+    Methods:
+        reverse: Resolve a single point
+        reverse_many: Resolve a batch of points in one pass and save the cache
+    """
+
+    def __init__(self, backend=None, cache_file=GEOCODE_CACHE_FILE, level=13):
+        self.backend = backend
+        self.cache_file = cache_file
+        self.level = level
+        self.cache = self._load()
+
+    def _load(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return {}
+        with open(self.cache_file, "r", encoding="utf-8") as f:
+            try:
+                return json.load(f)
+            except Exception as e:
+                print(f"json load {self.cache_file} \nerror {e}")
+                return {}
+
+    def save(self):
+        if not self.cache_file:
+            return
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        with open(self.cache_file, "w", encoding="utf-8") as f:
+            json.dump(self.cache, f, ensure_ascii=False)
+
+    def cell_token(self, lat, lon):
+        latlng = s2.LatLng.from_degrees(lat, lon)
+        return s2.CellId.from_lat_lng(latlng).parent(self.level).to_token()
+
+    def reverse(self, lat, lon):
+        return self.reverse_many([(lat, lon)])[0]
+
+    def reverse_many(self, points):
+        """Return the location of every (lat, lon) in points, None if unknown."""
+        tokens = [self.cell_token(lat, lon) for lat, lon in points]
+        misses = {}
+        for token, point in zip(tokens, points):
+            if token not in self.cache and token not in misses:
+                misses[token] = point
+        if misses and self.backend is not None:
+            print(f"reverse geocoding {len(misses)} new locations")
+            for token, (lat, lon) in misses.items():
+                location = self.backend.reverse(lat, lon)
+                if location:
+                    self.cache[token] = location
+            self.save()
+        return [self.cache.get(token) for token in tokens]
+
+
+_geocoder = None
+
+
+def make_backend(name):
+    """Backend for a GEOCODE_BACKEND value, None to only use the cache."""
+    if name not in ("auto", "offline", "nominatim", "none"):
+        print(f"Unknown GEOCODE_BACKEND {name}, using auto")
+        name = "auto"
+    if name == "nominatim":
+        return NominatimBackend()
+    if name in ("auto", "offline") and GEOCODE_OFFLINE_FILE:
+        return OfflineBackend(GEOCODE_OFFLINE_FILE)
+    if name == "offline":
+        print("GEOCODE_BACKEND is offline but GEOCODE_OFFLINE_FILE is not set")
+    return None
+
+
+def get_geocoder():
+    """Return the geocoder configured by the GEOCODE_* environment variables."""
+    global _geocoder
+    if _geocoder is None:
+        _geocoder = Geocoder(
+            make_backend(GEOCODE_BACKEND), GEOCODE_CACHE_FILE, GEOCODE_CELL_LEVEL
+        )
+    return _geocoder
@@ -146,10 +146,11 @@ class CircularDrawer(TracksDrawer):
                 path.push(
                     f"a{r3},{r3} 0 0,1 {r3 * (sin_a3 - sin_a1)},{r3 * (cos_a1 - cos_a3)}"
                 )
-                dr.add(path)
+                # TextPath gives the path its id, create it before the path is written
                 tpath = svgwrite.text.TextPath(
                     path, date.strftime("%B"), startOffset=(0.5 * r3 * (a3 - a1))
                 )
+                dr.add(path)
                 text = dr.text(
                     "",
                     fill=self.poster.colors["text"],
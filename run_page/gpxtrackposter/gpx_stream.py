@@ -0,0 +1,402 @@
+"""Read GPX files with lxml iterparse instead of building a gpxpy object tree."""
+
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import math
+from array import array
+from collections import namedtuple
+
+import numpy as np
+from gpxpy import geo as gpx_geo
+from gpxpy.gpx import DEFAULT_STOPPED_SPEED_THRESHOLD, MovingData, UphillDownhill
+from gpxpy.gpxfield import parse_time
+from lxml import etree
+
+from .exceptions import TrackLoadError
+
+GPXStreamPoint = namedtuple(
+    "GPXStreamPoint", "latitude longitude elevation time heart_rate"
+)
+
+# seconds_threshold of Track._calc_moving_time
+MOVING_TIME_THRESHOLD = datetime.timedelta(seconds=10)
+# times of points without a time
+NO_TIME = -(2**63)
+_EPOCH = datetime.datetime(1970, 1, 1)
+_EPOCH_UTC = _EPOCH.replace(tzinfo=datetime.timezone.utc)
+
+
+def _localname(tag):
+    return tag.rpartition("}")[2] if isinstance(tag, str) else None
+
+
+def _parse_float(text):
+    return None if text is None else float(text.strip())
+
+
+def _parse_time(text):
+    try:
+        return parse_time(text)
+    except Exception:
+        return None
+
+
+def _location(latitude, longitude):
+    return gpx_geo.Location(float(latitude), float(longitude))
+
+
+def _microseconds(time):
+    if time is None:
+        return NO_TIME
+    epoch = _EPOCH if time.tzinfo is None else _EPOCH_UTC
+    return (time - epoch) // datetime.timedelta(microseconds=1)
+
+
+def _simplify(lat, lng, max_distance=10):
+    """gpxpy.geo.simplify_polyline without recursion or list copies.
+
+    Takes the latitude and longitude arrays of a segment and returns the
+    indices of the kept points, the same points gpxpy keeps. The farthest
+    point of each range is searched with numpy.
+    """
+    if len(lat) < 3:
+        return list(range(len(lat)))
+    keep = {0, len(lat) - 1}
+    ranges = [(0, len(lat) - 1)]
+    while ranges:
+        lo, hi = ranges.pop()
+        if hi - lo < 2:
+            continue
+        begin, end = _location(lat[lo], lng[lo]), _location(lat[hi], lng[hi])
+        a, b, c = gpx_geo.get_line_equation_coefficients(begin, end)
+        d = np.abs(a * lat[lo + 1 : hi] + b * lng[lo + 1 : hi] + c)
+        position = lo + 1
+        if d.max() > 0:
+            position += int(np.argmax(d))
+        real_max_distance = gpx_geo.distance_from_line(
+            _location(lat[position], lng[position]), begin, end
+        )
+        if real_max_distance is not None and real_max_distance < max_distance:
+            continue
+        keep.add(position)
+        ranges.append((lo, position))
+        ranges.append((position, hi))
+    return sorted(keep)
+
+
+def _moving_data(segment):
+    # same as gpxpy GPXTrackSegment.get_moving_data, without max speed
+    moving_time = 0.0
+    stopped_time = 0.0
+    moving_distance = 0.0
+    stopped_distance = 0.0
+    lat, lng, times = segment.latitudes, segment.longitudes, segment.times
+    elevations = segment.elevation_list()
+    for i in range(1, len(segment)):
+        if times[i] != NO_TIME and times[i - 1] != NO_TIME:
+            if elevations[i] and elevations[i - 1]:
+                distance = gpx_geo.distance(
+                    lat[i],
+                    lng[i],
+                    elevations[i],
+                    lat[i - 1],
+                    lng[i - 1],
+                    elevations[i - 1],
+                )
+            else:
+                distance = gpx_geo.distance(
+                    lat[i], lng[i], None, lat[i - 1], lng[i - 1], None
+                )
+            # exact like timedelta.total_seconds
+            seconds = (times[i] - times[i - 1]) / 10**6
+            if seconds > 0 and distance:
+                speed_kmh = (distance / 1000) / (seconds / 60**2)
+                if speed_kmh <= DEFAULT_STOPPED_SPEED_THRESHOLD:
+                    stopped_time += seconds
+                    stopped_distance += distance
+                else:
+                    moving_time += seconds
+                    moving_distance += distance
+    return MovingData(moving_time, stopped_time, moving_distance, stopped_distance, 0.0)
+
+
+class GPXStreamSegment:
+    """The points of a trkseg as compact arrays.
+
+    Summaries Track._load_gpx_data reads before simplify (length and
+    Track._calc_moving_time) are added up by append while parsing. Moving
+    data, uphill and heart rate are read after simplify, of the kept points
+    only, so the arrays keep what those need.
+    """
+
+    def __init__(self):
+        self.latitudes = array("d")
+        self.longitudes = array("d")
+        # nan for a point without elevation
+        self.elevations = array("d")
+        # microseconds since the epoch, NO_TIME for a point without time
+        self.times = array("q")
+        # 0 for a point without heart rate
+        self.heart_rates = array("l")
+        self.length_2d = 0
+        self._moving_time = 0
+        self._previous = None
+
+    def __len__(self):
+        return len(self.latitudes)
+
+    @property
+    def moving_time(self):
+        """Track._calc_moving_time of the segment, 0 if it failed."""
+        return int(self._moving_time) if self._moving_time is not None else 0
+
+    def append(self, point, start_time):
+        """Add a GPXStreamPoint, start_time is the first time of the file."""
+        previous = self._previous
+        if previous is not None:
+            # same as gpxpy.geo.length, current point first
+            d = gpx_geo.distance(
+                point.latitude,
+                point.longitude,
+                None,
+                previous.latitude,
+                previous.longitude,
+                None,
+            )
+            if d:
+                self.length_2d += d
+            self._add_moving_time(
+                previous, point, start_time if len(self) == 1 else previous.time
+            )
+        self.latitudes.append(point.latitude)
+        self.longitudes.append(point.longitude)
+        self.elevations.append(math.nan if point.elevation is None else point.elevation)
+        self.times.append(_microseconds(point.time))
+        self.heart_rates.append(point.heart_rate or 0)
+        self._previous = point
+
+    def _add_moving_time(self, previous, point, start_time):
+        # one step of Track._calc_moving_time
+        if self._moving_time is None:
+            return
+        try:
+            if point.time - previous.time <= MOVING_TIME_THRESHOLD:
+                self._moving_time += point.time.timestamp() - start_time.timestamp()
+        except Exception as e:
+            print(f"Error calculating moving time: {e}")
+            self._moving_time = None
+
+    @property
+    def heart_rate_sum(self):
+        return sum(self.heart_rates)
+
+    @property
+    def heart_rate_count(self):
+        return len(self.heart_rates) - self.heart_rates.count(0)
+
+    def elevation_list(self):
+        return [None if math.isnan(e) else e for e in self.elevations]
+
+    def latlngs(self):
+        """(lat, lng) pairs of the points as an (n, 2) float array."""
+        return np.column_stack(
+            (np.asarray(self.latitudes), np.asarray(self.longitudes))
+        )
+
+    def keep(self, indices):
+        """Drop all points but the ones at indices."""
+        self.latitudes = array("d", [self.latitudes[i] for i in indices])
+        self.longitudes = array("d", [self.longitudes[i] for i in indices])
+        self.elevations = array("d", [self.elevations[i] for i in indices])
+        self.times = array("q", [self.times[i] for i in indices])
+        self.heart_rates = array("l", [self.heart_rates[i] for i in indices])
+
+
+class GPXStreamTrack:
+    def __init__(self):
+        self.name = None
+        self.type = None
+        self.source = None
+        self.number = None
+        self.start_time = None
+        self.end_time = None
+        self.segments = []
+
+
+class GPXStream:
+    """The parts of a gpxpy.gpx.GPX that Track._load_gpx_data reads.
+
+    The XML tree is dropped while parsing, time bounds and segment summaries
+    are collected in the same pass. The summary methods add them up the way
+    gpxpy does so both loaders give the same track.
+    """
+
+    def __init__(self):
+        self.creator = None
+        self.name = None
+        self.tracks = []
+        self.extensions = []
+
+    def get_time_bounds(self):
+        start_time = None
+        end_time = None
+        for track in self.tracks:
+            if not start_time:
+                start_time = track.start_time
+            if track.end_time:
+                end_time = track.end_time
+        return start_time, end_time
+
+    def length_2d(self):
+        result = 0
+        for track in self.tracks:
+            length = 0
+            for segment in track.segments:
+                if segment.length_2d:
+                    length += segment.length_2d
+            if length:
+                result += length
+        return result
+
+    def simplify(self, max_distance=None):
+        for track in self.tracks:
+            for segment in track.segments:
+                indices = _simplify(
+                    np.asarray(segment.latitudes),
+                    np.asarray(segment.longitudes),
+                    10 if max_distance is None else max_distance,
+                )
+                if len(indices) < len(segment):
+                    segment.keep(indices)
+
+    def get_moving_data(self):
+        moving_time = 0.0
+        stopped_time = 0.0
+        moving_distance = 0.0
+        stopped_distance = 0.0
+        for track in self.tracks:
+            track_data = [0.0, 0.0, 0.0, 0.0]
+            for segment in track.segments:
+                segment_data = _moving_data(segment)
+                for i in range(4):
+                    track_data[i] += segment_data[i]
+            moving_time += track_data[0]
+            stopped_time += track_data[1]
+            moving_distance += track_data[2]
+            stopped_distance += track_data[3]
+        return MovingData(
+            moving_time, stopped_time, moving_distance, stopped_distance, 0.0
+        )
+
+    def get_uphill_downhill(self):
+        uphill = 0
+        downhill = 0
+        for track in self.tracks:
+            track_uphill = 0
+            track_downhill = 0
+            for segment in track.segments:
+                if not len(segment):
+                    continue
+                current_uphill, current_downhill = gpx_geo.calculate_uphill_downhill(
+                    segment.elevation_list()
+                )
+                track_uphill += current_uphill or 0.0
+                track_downhill += current_downhill or 0.0
+            uphill += track_uphill or 0
+            downhill += track_downhill or 0
+        return UphillDownhill(uphill, downhill)
+
+
+def _read_point(element):
+    elevation = time = heart_rate = None
+    for child in element:
+        name = _localname(child.tag)
+        if name == "ele":
+            elevation = _parse_float(child.text)
+        elif name == "time":
+            time = _parse_time(child.text)
+        elif name == "extensions":
+            # like Track._load_gpx_data, only the first extension is searched
+            extension = next((e for e in child if _localname(e.tag)), None)
+            if extension is not None:
+                for item in extension:
+                    if _localname(item.tag) == "hr":
+                        heart_rate = int(item.text)
+    latitude = _parse_float(element.get("lat"))
+    longitude = _parse_float(element.get("lon"))
+    if latitude is None or longitude is None:
+        raise TrackLoadError("Track point without lat/lon")
+    return GPXStreamPoint(
+        latitude,
+        longitude,
+        elevation,
+        time,
+        heart_rate,
+    )
+
+
+def _free(element):
+    # drop parsed elements so memory does not grow with the file
+    element.clear()
+    while element.getprevious() is not None:
+        del element.getparent()[0]
+
+
+def parse(file_name):
+    """Stream file_name into a GPXStream in one pass."""
+    gpx = GPXStream()
+    track = None
+    segment = None
+    start_time = None
+    context = etree.iterparse(file_name, events=("start", "end"), huge_tree=True)
+    try:
+        for event, element in context:
+            name = _localname(element.tag)
+            if event == "start":
+                if name == "trk":
+                    track = GPXStreamTrack()
+                    gpx.tracks.append(track)
+                elif name == "trkseg" and track is not None:
+                    segment = GPXStreamSegment()
+                    track.segments.append(segment)
+                continue
+            parent = element.getparent()
+            parent_name = _localname(parent.tag) if parent is not None else None
+            if name == "trkpt" and segment is not None:
+                point = _read_point(element)
+                if point.time:
+                    start_time = start_time or point.time
+                    track.start_time = track.start_time or point.time
+                    track.end_time = point.time
+                segment.append(point, start_time)
+                _free(element)
+            elif name == "trkseg":
+                segment = None
+            elif parent_name == "trk" and name in ("name", "type", "src", "number"):
+                if name == "name":
+                    track.name = element.text
+                elif name == "type":
+                    track.type = element.text
+                elif name == "src":
+                    track.source = element.text
+                else:
+                    track.number = (
+                        None if element.text is None else int(element.text.strip())
+                    )
+            elif name == "trk":
+                track = None
+                _free(element)
+            elif name == "name" and parent_name in ("gpx", "metadata"):
+                gpx.name = element.text
+            elif name == "extensions" and parent_name == "gpx":
+                gpx.extensions = [e for e in element if _localname(e.tag)]
+            elif name in ("wpt", "rte"):
+                _free(element)
+    except etree.XMLSyntaxError as e:
+        raise TrackLoadError(f"Invalid GPX file: {e}")
+    if context.root is None or _localname(context.root.tag) != "gpx":
+        raise TrackLoadError("Not a GPX file")
+    gpx.creator = context.root.get("creator")
+    return gpx
@@ -11,7 +11,7 @@ from .exceptions import PosterError
 from .poster import Poster
 from .track import Track
 from .tracks_drawer import TracksDrawer
-from .utils import compute_grid, format_float, project
+from .utils import compute_grid, format_float, project_lines
 from .xy import XY
 
 
@@ -58,7 +58,7 @@ class GridDrawer(TracksDrawer):
         str_length = format_float(self.poster.m2u(tr.length))
 
         date_title = f"{str(tr.start_time_local)[:10]} {str_length}km"
-        for line in project(tr.bbox(), size, offset, tr.polylines):
+        for line in project_lines(tr.bbox(), size, offset, tr.lines):
             distance1 = self.poster.special_distance["special_distance"]
             distance2 = self.poster.special_distance["special_distance2"]
             has_special = distance1 < tr.length / 1000 < distance2
@@ -68,7 +68,7 @@ class GridDrawer(TracksDrawer):
                     "special"
                 )
             polyline = dr.polyline(
-                points=line,
+                points=line.tolist(),
                 stroke=color,
                 fill="none",
                 stroke_width=0.5,
@@ -6,8 +6,8 @@ from collections import defaultdict
 from datetime import datetime
 
 import pytz
-import svgwrite
 
+from .svg_stream import StreamingDrawing
 from .utils import format_float
 from .value_range import ValueRange
 from .xy import XY
@@ -115,15 +115,21 @@ class Poster:
             self.colors["track"] = "red"
             self.colors["special"] = "yellow"
             self.colors["text"] = "#e1ed5e"
-        d = svgwrite.Drawing(output, (f"{width}mm", f"{height}mm"))
+        # elements are written to output as they are drawn, svgwrite's debug
+        # validation of every coordinate is skipped, it does not change the output
+        d = StreamingDrawing(output, (f"{width}mm", f"{height}mm"), debug=False)
         d.viewbox(0, 0, self.width, height)
-        d.add(d.rect((0, 0), (width, height), fill=self.colors["background"]))
-        if not self.drawer_type == "plain":
-            self.__draw_header(d)
-            self.__draw_footer(d)
-            self.__draw_tracks(d, XY(width - 20, height - 30 - 30), XY(10, 30))
-        else:
-            self.__draw_tracks(d, XY(width - 20, height), XY(10, 0))
+        try:
+            d.add(d.rect((0, 0), (width, height), fill=self.colors["background"]))
+            if not self.drawer_type == "plain":
+                self.__draw_header(d)
+                self.__draw_footer(d)
+                self.__draw_tracks(d, XY(width - 20, height - 30 - 30), XY(10, 30))
+            else:
+                self.__draw_tracks(d, XY(width - 20, height), XY(10, 0))
+        except Exception:
+            d.abort()
+            raise
         d.save()
 
     def m2u(self, m):
@@ -0,0 +1,62 @@
+"""Write a poster to its SVG file while it is being drawn."""
+
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import os
+
+import svgwrite
+
+XML_HEADER = '<?xml version="1.0" encoding="utf-8" ?>\n'
+
+
+class StreamingDrawing(svgwrite.Drawing):
+    """svgwrite.Drawing that writes every element to the file when it is added.
+
+    Drawers keep using the svgwrite element factories and add(), but the element
+    is serialized right away instead of being kept in the DOM, so memory does not
+    grow with the number of tracks. The output is the same as Drawing.save().
+
+    Elements must be complete when they are added, and the attributes of the
+    drawing itself (size, viewbox) must be set before the first add().
+
+    Methods:
+        add: Write an element to the file
+        save: Close the svg element and the file
+        abort: Close and remove a partially written file
+    """
+
+    def __init__(self, filename, size=("100%", "100%"), **extra):
+        self._file = None
+        # svgwrite adds the defs element while initializing, keep that in the DOM
+        self._streaming = False
+        super().__init__(filename, size, **extra)
+        self._streaming = True
+
+    def _open(self):
+        self._file = open(self.filename, "w", encoding="utf-8")
+        self._file.write(XML_HEADER)
+        # the root and what was added to it so far (defs), without the closing tag
+        root = super().tostring()
+        self._file.write(root[: -len("</svg>")])
+        self.elements = []
+
+    def add(self, element):
+        if not self._streaming:
+            return super().add(element)
+        if self._file is None:
+            self._open()
+        self._file.write(element.tostring())
+        return element
+
+    def save(self, pretty=False, indent=2):
+        if self._file is None:
+            self._open()
+        self._file.write("</svg>")
+        self._file.close()
+
+    def abort(self):
+        if self._file is None:
+            return
+        self._file.close()
+        os.remove(self.filename)
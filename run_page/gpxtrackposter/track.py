@@ -7,11 +7,13 @@
 
 import datetime
 from datetime import timezone
+import math
 import os
 from collections import namedtuple
 
 import gpxpy as mod_gpxpy
 import lxml
+import numpy as np
 import polyline
 import s2sphere as s2
 from garmin_fit_sdk import Decoder, Stream
@@ -20,6 +22,7 @@ from polyline_processor import filter_out
 from rich import print
 from tcxreader.tcxreader import TCXReader
 
+from . import gpx_stream
 from .exceptions import TrackLoadError
 from .utils import parse_datetime_to_local
 
@@ -36,10 +39,68 @@ IGNORE_BEFORE_SAVING = os.getenv("IGNORE_BEFORE_SAVING", False)
 SEMICIRCLE = 11930465
 
 
+def to_line(points):
+    """Pack (lat, lng) pairs in degrees into a contiguous (n, 2) float array."""
+    return np.array(points, dtype=float).reshape(-1, 2)
+
+
+def decode_summary_polyline(summary_polyline):
+    """Decode a summary polyline from the db into (lat, lng) pairs."""
+    if IGNORE_BEFORE_SAVING:
+        summary_polyline = filter_out(summary_polyline)
+    return polyline.decode(summary_polyline) if summary_polyline else []
+
+
+def _lng_interval(lng):
+    """Smallest s2.SphereInterval (radians) that contains all lng (degrees)."""
+    lng = np.sort(lng)
+    lo, hi = lng[0], lng[-1]
+    if hi - lo > 180:
+        # the track may cross the antimeridian, leave out the largest gap
+        gaps = np.diff(lng)
+        i = int(np.argmax(gaps))
+        if gaps[i] > 360 - (hi - lo):
+            lo, hi = lng[i + 1], lng[i]
+    return s2.SphereInterval(math.radians(lo), math.radians(hi))
+
+
 class Track:
+    """
+    Attributes:
+        lines: Coordinates of each segment as (n, 2) float arrays of lat, lng
+            in degrees, the only copy of the points kept by the track.
+            Tracks loaded from the db decode their summary polyline on first
+            access, posters that do not draw the routes never decode it.
+        polylines: s2.LatLng lists built from lines on demand.
+        polyline_container: All points as [lat, lng] lists, built on demand.
+    """
+
+    __slots__ = (
+        "file_names",
+        "_lines",
+        "_summary_polyline",
+        "polyline_str",
+        "track_name",
+        "start_time",
+        "end_time",
+        "start_time_local",
+        "end_time_local",
+        "length",
+        "special",
+        "average_heartrate",
+        "elevation_gain",
+        "moving_dict",
+        "run_id",
+        "start_latlng",
+        "type",
+        "source",
+        "name",
+    )
+
     def __init__(self):
         self.file_names = []
-        self.polylines = []
+        self._lines = []
+        self._summary_polyline = None
         self.polyline_str = ""
         self.track_name = None
         self.start_time = None
@@ -57,9 +118,11 @@ class Track:
         self.source = ""
         self.name = ""
 
-    def load_gpx(self, file_name):
+    def load_gpx(self, file_name, stream=False):
         """
         TODO refactor with load_tcx to one function
+
+        With stream=True the file is read by gpx_stream instead of gpxpy.
         """
         try:
             self.file_names = [os.path.basename(file_name)]
@@ -67,6 +130,9 @@ class Track:
             # (for example, treadmill runs pulled via garmin-connect-export)
             if os.path.getsize(file_name) == 0:
                 raise TrackLoadError("Empty GPX file")
+            if stream:
+                self._load_gpx_data(gpx_stream.parse(file_name))
+                return
             with open(file_name, "r", encoding="utf-8", errors="ignore") as file:
                 self._load_gpx_data(mod_gpxpy.parse(file))
         except Exception as e:
@@ -131,21 +197,47 @@ class Track:
         self.start_time_local = start_time
         self.end_time = start_time + activity.elapsed_time
         self.length = float(activity.distance)
-        if IGNORE_BEFORE_SAVING:
-            summary_polyline = filter_out(activity.summary_polyline)
-        else:
-            summary_polyline = activity.summary_polyline
-        polyline_data = polyline.decode(summary_polyline) if summary_polyline else []
-        self.polylines = [[s2.LatLng.from_degrees(p[0], p[1]) for p in polyline_data]]
+        # decoded by the lines property when a drawer needs the route
+        self._summary_polyline = activity.summary_polyline
+        self._lines = None
         self.run_id = activity.run_id
 
+    @property
+    def lines(self):
+        if self._lines is None:
+            polyline_data = decode_summary_polyline(self._summary_polyline)
+            self._lines = [to_line(polyline_data)]
+            self._summary_polyline = None
+        return self._lines
+
+    @lines.setter
+    def lines(self, lines):
+        self._lines = lines
+        self._summary_polyline = None
+
+    @property
+    def polylines(self):
+        return [
+            [s2.LatLng.from_degrees(lat, lng) for lat, lng in line.tolist()]
+            for line in self.lines
+        ]
+
+    @property
+    def polyline_container(self):
+        if not self.lines:
+            return []
+        return np.concatenate(self.lines).tolist()
+
     def bbox(self):
         """Compute the smallest rectangle that contains the entire track (border box)."""
-        bbox = s2.LatLngRect()
-        for line in self.polylines:
-            for latlng in line:
-                bbox = bbox.union(s2.LatLngRect.from_point(latlng.normalized()))
-        return bbox
+        if not any(len(line) for line in self.lines):
+            return s2.LatLngRect()
+        points = np.concatenate(self.lines)
+        lat = np.clip(points[:, 0], -90, 90)
+        return s2.LatLngRect(
+            s2.LineInterval(math.radians(lat.min()), math.radians(lat.max())),
+            _lng_interval(points[:, 1]),
+        )
 
     @staticmethod
     def __make_run_id(time_stamp):
@@ -166,17 +258,14 @@ class Track:
         moving_time = moving_time or elapsed_time
         self.run_id = self.__make_run_id(self.start_time)
         self.average_heartrate = tcx.hr_avg
-        polyline_container = []
         position_values = [(i.latitude, i.longitude) for i in tcx.trackpoints]
         if not position_values and int(self.length) == 0:
             raise Exception(
                 f"This {file_name} TCX file do not contain distance and position values we ignore it"
             )
         if position_values:
-            line = [s2.LatLng.from_degrees(p[0], p[1]) for p in position_values]
-            self.polylines.append(line)
-            polyline_container.extend([[p[0], p[1]] for p in position_values])
-            self.polyline_container = polyline_container
+            self.lines.append(to_line(position_values))
+            polyline_container = self.polyline_container
             self.start_time_local, self.end_time_local = parse_datetime_to_local(
                 self.start_time, self.end_time, polyline_container[0]
             )
@@ -235,13 +324,16 @@ class Track:
         moving_time = 0
         for t in gpx.tracks:
             for s in t.segments:
-                moving_time += self._calc_moving_time(s.points, 10)
+                if isinstance(s, gpx_stream.GPXStreamSegment):
+                    moving_time += s.moving_time
+                else:
+                    moving_time += self._calc_moving_time(s.points, 10)
         gpx.simplify()
         if self.length == 0:
             self._load_gpx_extensions_data(gpx)
             return
-        polyline_container = []
-        heart_rate_list = []
+        heart_rate_sum = 0
+        heart_rate_count = 0
         # determinate type
         if gpx.tracks[0].type:
             self.type = gpx.tracks[0].type
@@ -268,33 +360,39 @@ class Track:
             if hasattr(t, "type") and t.type:
                 self.type = "Run" if t.type == "running" else t.type
             for s in t.segments:
-                try:
-                    extensions = [
-                        {
-                            lxml.etree.QName(child).localname: child.text
-                            for child in p.extensions[0]
-                        }
-                        for p in s.points
-                        if p.extensions
-                    ]
-                    heart_rate_list.extend(
-                        [
-                            int(p["hr"]) if p.__contains__("hr") else None
-                            for p in extensions
-                            if extensions
+                if isinstance(s, gpx_stream.GPXStreamSegment):
+                    heart_rate_sum += s.heart_rate_sum
+                    heart_rate_count += s.heart_rate_count
+                    latlngs = s.latlngs()
+                else:
+                    try:
+                        extensions = [
+                            {
+                                lxml.etree.QName(child).localname: child.text
+                                for child in p.extensions[0]
+                            }
+                            for p in s.points
+                            if p.extensions
                         ]
-                    )
-                    heart_rate_list = list(filter(None, heart_rate_list))
-                except lxml.etree.XMLSyntaxError:
-                    # Ignore XML syntax errors in extensions
-                    # This can happen if the GPX file is malformed
-                    pass
-                line = [
-                    s2.LatLng.from_degrees(p.latitude, p.longitude) for p in s.points
-                ]
-                self.polylines.append(line)
-                polyline_container.extend([[p.latitude, p.longitude] for p in s.points])
-                self.polyline_container = polyline_container
+                        heart_rate_list = list(
+                            filter(
+                                None,
+                                [
+                                    int(p["hr"]) if p.__contains__("hr") else None
+                                    for p in extensions
+                                    if extensions
+                                ],
+                            )
+                        )
+                        heart_rate_sum += sum(heart_rate_list)
+                        heart_rate_count += len(heart_rate_list)
+                    except lxml.etree.XMLSyntaxError:
+                        # Ignore XML syntax errors in extensions
+                        # This can happen if the GPX file is malformed
+                        pass
+                    latlngs = [(p.latitude, p.longitude) for p in s.points]
+                self.lines.append(to_line(latlngs))
+        polyline_container = self.polyline_container
         # get start point
         try:
             self.start_latlng = start_point(*polyline_container[0])
@@ -307,7 +405,7 @@ class Track:
             )
         self.polyline_str = polyline.encode(polyline_container)
         self.average_heartrate = (
-            sum(heart_rate_list) / len(heart_rate_list) if heart_rate_list else None
+            heart_rate_sum / heart_rate_count if heart_rate_count else None
         )
         self.moving_dict = self._get_moving_data(gpx, moving_time)
         self.elevation_gain = gpx.get_uphill_downhill().uphill
@@ -375,8 +473,7 @@ class Track:
         )
 
     def _load_fit_data(self, fit: dict):
-        _polylines = []
-        self.polyline_container = []
+        polyline_container = []
         message = fit["session_mesgs"][0]
         self.start_time = datetime.datetime.fromtimestamp(
             (message["start_time"] + FIT_EPOCH_S), tz=timezone.utc
@@ -419,15 +516,14 @@ class Track:
             if "position_lat" in record and "position_long" in record:
                 lat = record["position_lat"] / SEMICIRCLE
                 lng = record["position_long"] / SEMICIRCLE
-                _polylines.append(s2.LatLng.from_degrees(lat, lng))
-                self.polyline_container.append([lat, lng])
-        if self.polyline_container:
+                polyline_container.append([lat, lng])
+        if polyline_container:
             self.start_time_local, self.end_time_local = parse_datetime_to_local(
-                self.start_time, self.end_time, self.polyline_container[0]
+                self.start_time, self.end_time, polyline_container[0]
             )
-            self.start_latlng = start_point(*self.polyline_container[0])
-            self.polylines.append(_polylines)
-            self.polyline_str = polyline.encode(self.polyline_container)
+            self.start_latlng = start_point(*polyline_container[0])
+            self.lines.append(to_line(polyline_container))
+            self.polyline_str = polyline.encode(polyline_container)
         else:
             self.start_time_local, self.end_time_local = parse_datetime_to_local(
                 self.start_time, self.end_time, None
@@ -442,7 +538,7 @@ class Track:
             self.moving_dict["distance"] += other.moving_dict["distance"]
             self.moving_dict["moving_time"] += other.moving_dict["moving_time"]
             self.moving_dict["elapsed_time"] += other.moving_dict["elapsed_time"]
-            self.polyline_container.extend(other.polyline_container)
+            self.lines.extend(other.lines)
             self.polyline_str = polyline.encode(self.polyline_container)
             self.moving_dict["average_speed"] = (
                 self.moving_dict["distance"]
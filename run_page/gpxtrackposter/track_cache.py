@@ -0,0 +1,210 @@
+"""Persistent cache of parsed tracks, so unchanged GPX/TCX/FIT files are never re-parsed."""
+
+# Use of this source code is governed by a MIT-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+import polyline
+
+from .track import Track, start_point, to_line
+
+log = logging.getLogger(__name__)
+
+# bump this when the parsing logic in Track changes, so stale summaries are dropped
+CACHE_VERSION = 1
+
+
+def file_digest(file_name):
+    with open(file_name, "rb") as f:
+        return hashlib.file_digest(f, "sha1").hexdigest()
+
+
+def _datetime_to_str(d):
+    return d.isoformat() if d else None
+
+
+def _str_to_datetime(s):
+    return datetime.datetime.fromisoformat(s) if s else None
+
+
+def track_to_dict(t: Track) -> dict:
+    """Serialize the derived summary of a loaded track into a JSON-friendly dict."""
+    moving_dict = {
+        k: v.total_seconds() if isinstance(v, datetime.timedelta) else v
+        for k, v in t.moving_dict.items()
+    }
+    return {
+        "file_names": t.file_names,
+        "run_id": t.run_id,
+        "track_name": t.track_name,
+        "name": t.name,
+        "type": t.type,
+        "source": t.source,
+        "start_time": _datetime_to_str(t.start_time),
+        "end_time": _datetime_to_str(t.end_time),
+        "start_time_local": _datetime_to_str(t.start_time_local),
+        "end_time_local": _datetime_to_str(t.end_time_local),
+        "length": t.length,
+        "average_heartrate": t.average_heartrate,
+        "elevation_gain": t.elevation_gain,
+        "moving_dict": moving_dict,
+        "start_latlng": list(t.start_latlng) if t.start_latlng else [],
+        "polyline_str": t.polyline_str,
+        # number of points of each segment, to rebuild polylines from polyline_str
+        "segments": [len(line) for line in t.lines],
+    }
+
+
+def track_from_dict(d: dict) -> Track:
+    """Rebuild a Track from the output of track_to_dict without touching the source file."""
+    t = Track()
+    t.file_names = d["file_names"]
+    t.run_id = d["run_id"]
+    t.track_name = d["track_name"]
+    t.name = d["name"]
+    t.type = d["type"]
+    t.source = d["source"]
+    t.start_time = _str_to_datetime(d["start_time"])
+    t.end_time = _str_to_datetime(d["end_time"])
+    t.start_time_local = _str_to_datetime(d["start_time_local"])
+    t.end_time_local = _str_to_datetime(d["end_time_local"])
+    t.length = d["length"]
+    t.average_heartrate = d["average_heartrate"]
+    t.elevation_gain = d["elevation_gain"]
+    t.moving_dict = {
+        k: (
+            datetime.timedelta(seconds=v) if k in ("moving_time", "elapsed_time") else v
+        )
+        for k, v in d["moving_dict"].items()
+    }
+    if d["start_latlng"]:
+        t.start_latlng = start_point(*d["start_latlng"])
+    t.polyline_str = d["polyline_str"]
+    if t.polyline_str:
+        points = to_line(polyline.decode(t.polyline_str))
+        index = 0
+        for size in d["segments"]:
+            t.lines.append(points[index : index + size].copy())
+            index += size
+    return t
+
+
+class TrackCache:
+    """Parse cache for track files, stored as one JSON file.
+
+    Entries are keyed on the file path relative to its data dir parent
+    (e.g. "GPX_OUT/123.gpx") and validated against size and mtime. When those
+    changed (fresh checkout, copied files) the content hash decides whether the
+    cached summary can still be used. On save, entries of data_dir whose file
+    was deleted or renamed, or whose content changed, are dropped. Files
+    skipped as already synced keep their entries, so the cache still serves a
+    reset imported.json or a rebuilt db.
+
+    Methods:
+        get: Return the cached Track for a file, or None if it must be parsed
+        put: Store the summary of a freshly parsed Track
+        save: Write the cache back to disk if anything changed
+    """
+
+    def __init__(self, cache_file, data_dir=None):
+        self.cache_file = cache_file
+        self.data_dir = os.path.abspath(data_dir) if data_dir else None
+        self.entries = self._load()
+        self.seen = set()
+        self.dirty = False
+
+    def _load(self):
+        if not os.path.exists(self.cache_file):
+            return {}
+        with open(self.cache_file, "r") as f:
+            try:
+                data = json.load(f)
+            except Exception as e:
+                print(f"json load {self.cache_file} \nerror {e}")
+                return {}
+        if data.get("version") != CACHE_VERSION:
+            return {}
+        return data.get("tracks", {})
+
+    @staticmethod
+    def _key(file_name):
+        file_name = os.path.abspath(file_name)
+        return os.path.join(
+            os.path.basename(os.path.dirname(file_name)), os.path.basename(file_name)
+        )
+
+    def get(self, file_name):
+        key = self._key(file_name)
+        self.seen.add(key)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        stat = os.stat(file_name)
+        if entry["size"] != stat.st_size:
+            return None
+        if entry["mtime"] != stat.st_mtime:
+            if entry["sha1"] != file_digest(file_name):
+                return None
+            # same content with a new mtime, remember it to skip hashing next time
+            entry["mtime"] = stat.st_mtime
+            self.dirty = True
+        try:
+            return track_from_dict(entry["track"])
+        except Exception as e:
+            log.error(f"Broken cache entry for {file_name}: {e}")
+            return None
+
+    def put(self, file_name, t: Track):
+        # only cache tracks that loaded, failed files are retried on the next run
+        if t.start_time is None:
+            return
+        stat = os.stat(file_name)
+        key = self._key(file_name)
+        self.seen.add(key)
+        self.entries[key] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha1": file_digest(file_name),
+            "track": track_to_dict(t),
+        }
+        self.dirty = True
+
+    def _is_stale(self, key, entry):
+        """Whether the file of an entry not read by this load is gone or changed"""
+        file_name = os.path.join(os.path.dirname(self.data_dir), key)
+        if not os.path.isfile(file_name):
+            return True
+        stat = os.stat(file_name)
+        if entry["size"] != stat.st_size:
+            return True
+        if entry["mtime"] != stat.st_mtime:
+            if entry["sha1"] != file_digest(file_name):
+                return True
+            entry["mtime"] = stat.st_mtime
+            self.dirty = True
+        return False
+
+    def save(self):
+        stale = []
+        if self.data_dir:
+            prefix = os.path.basename(self.data_dir) + os.sep
+            stale = [
+                key
+                for key, entry in self.entries.items()
+                if key.startswith(prefix)
+                and key not in self.seen
+                and self._is_stale(key, entry)
+            ]
+        for key in stale:
+            del self.entries[key]
+        if not self.dirty and not stale:
+            return
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        with open(self.cache_file, "w") as f:
+            json.dump({"version": CACHE_VERSION, "tracks": self.entries}, f)
+        self.dirty = False
@@ -13,45 +13,55 @@ import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 import concurrent.futures
 
-from generator.db import Activity, init_db
+from config import PARSE_CACHE_FILE
+from generator.db import Activity, ActivityRoute, init_db, with_summary_polyline
 
 from .exceptions import ParameterError, TrackLoadError
 from .track import Track
+from .track_cache import TrackCache
 from .year_range import YearRange
 
 from synced_data_file_logger import load_synced_file_list
 
 log = logging.getLogger(__name__)
 
+# set to any value to read GPX files with gpx_stream instead of gpxpy
+STREAM_GPX_PARSER = bool(os.getenv("STREAM_GPX_PARSER", ""))
 
-def load_gpx_file(file_name, activity_title_dict={}):
-    """Load an individual GPX file as a track by using Track.load_gpx()"""
-    t = Track()
-    t.load_gpx(file_name)
+
+def apply_activity_title(t, file_name, activity_title_dict):
     file_id = os.path.basename(file_name).split(".")[0]
     if activity_title_dict:
         t.track_name = activity_title_dict.get(file_id, t.track_name)
     return t
 
 
+def load_gpx_file(file_name, activity_title_dict={}):
+    """Load an individual GPX file as a track by using Track.load_gpx()"""
+    t = Track()
+    t.load_gpx(file_name)
+    return apply_activity_title(t, file_name, activity_title_dict)
+
+
+def load_gpx_stream_file(file_name, activity_title_dict={}):
+    """Load an individual GPX file as a track by using Track.load_gpx(stream=True)"""
+    t = Track()
+    t.load_gpx(file_name, stream=True)
+    return apply_activity_title(t, file_name, activity_title_dict)
+
+
 def load_tcx_file(file_name, activity_title_dict={}):
     """Load an individual TCX file as a track by using Track.load_tcx()"""
     t = Track()
     t.load_tcx(file_name)
-    file_id = os.path.basename(file_name).split(".")[0]
-    if activity_title_dict:
-        t.track_name = activity_title_dict.get(file_id, t.track_name)
-    return t
+    return apply_activity_title(t, file_name, activity_title_dict)
 
 
 def load_fit_file(file_name, activity_title_dict={}):
     """Load an individual FIT file as a track by using Track.load_fit()"""
     t = Track()
     t.load_fit(file_name)
-    file_id = os.path.basename(file_name).split(".")[0]
-    if activity_title_dict:
-        t.track_name = activity_title_dict.get(file_id, t.track_name)
-    return t
+    return apply_activity_title(t, file_name, activity_title_dict)
 
 
 class TrackLoader:
@@ -60,6 +70,8 @@ class TrackLoader:
         min_length: All tracks shorter than this value are filtered out.
         special_file_names: Tracks marked as special in command line args
         year_range: All tracks outside of this range will be filtered out.
+        cache_file: Parse cache used by load_tracks, None to always parse files
+        stream_gpx: Read GPX files with the lxml streaming parser instead of gpxpy
 
     Methods:
         load_tracks: Load all data from GPX files
@@ -69,6 +81,8 @@ class TrackLoader:
         self.min_length = 100
         self.special_file_names = []
         self.year_range = YearRange()
+        self.cache_file = PARSE_CACHE_FILE
+        self.stream_gpx = STREAM_GPX_PARSER
         self.load_func_dict = {
             "gpx": load_gpx_file,
             "tcx": load_tcx_file,
@@ -82,13 +96,29 @@ class TrackLoader:
 
         tracks = []
 
+        cache = TrackCache(self.cache_file, data_dir) if self.cache_file else None
+        cached_tracks = {}
+        if cache:
+            for file_name in file_names:
+                t = cache.get(file_name)
+                if t is not None:
+                    cached_tracks[file_name] = t
+            log.info(f"Tracks loaded from parse cache: {len(cached_tracks)}")
+
+        # titles are applied after loading so the cache only holds parsed data
+        load_func = self.load_func_dict.get(file_suffix, load_gpx_file)
+        if self.stream_gpx and load_func is load_gpx_file:
+            load_func = load_gpx_stream_file
         loaded_tracks = self._load_data_tracks(
-            file_names,
-            self.load_func_dict.get(file_suffix, load_gpx_file),
-            activity_title_dict,
+            [f for f in file_names if f not in cached_tracks], load_func
         )
+        if cache:
+            for file_name, t in loaded_tracks.items():
+                cache.put(file_name, t)
+            cache.save()
 
-        tracks.extend(loaded_tracks.values())
+        for file_name, t in {**cached_tracks, **loaded_tracks}.items():
+            tracks.append(apply_activity_title(t, file_name, activity_title_dict))
         log.info(f"Conventionally loaded tracks: {len(loaded_tracks)}")
 
         tracks = self._filter_tracks(tracks)
@@ -97,25 +127,24 @@ class TrackLoader:
 
     def load_tracks_from_db(self, sql_file, is_grid=False, is_circular=False):
         session = init_db(sql_file)
+        # only the grid draws routes, the other posters do not read activity_routes
         if is_grid:
             activities = (
-                session.query(Activity)
-                .filter(Activity.summary_polyline != "")
+                with_summary_polyline(session.query(Activity))
+                .filter(ActivityRoute.summary_polyline != "")
                 .filter(Activity.type.not_in(["Flight"]))
-                .order_by(Activity.start_date_local)
             )
         elif is_circular:
-            activities = (
-                session.query(Activity)
-                .filter(Activity.type.not_in(["RoadTrip", "Flight"]))
-                .order_by(Activity.start_date_local)
+            activities = session.query(Activity).filter(
+                Activity.type.not_in(["RoadTrip", "Flight"])
             )
         else:
-            activities = (
-                session.query(Activity)
-                .filter(Activity.type.not_in(["Flight"]))
-                .order_by(Activity.start_date_local)
+            activities = session.query(Activity).filter(
+                Activity.type.not_in(["Flight"])
             )
+        activities = activities.filter(*self._activity_filters()).order_by(
+            Activity.start_date_local
+        )
         tracks = []
         for activity in activities:
             t = Track()
@@ -126,6 +155,22 @@ class TrackLoader:
         print(f"After filter tracks: {len(tracks)}")
         return [t for t in tracks if t.length >= self.min_length]
 
+    def _activity_filters(self):
+        """
+        year_range and min_length as SQL conditions, so only the activities
+        _filter_tracks keeps are loaded. start_date_local is stored as
+        "%Y-%m-%d %H:%M:%S" and compares as text with the years.
+        """
+        filters = [Activity.distance >= self.min_length]
+        if self.year_range.from_year is not None:
+            filters.append(
+                Activity.start_date_local >= f"{self.year_range.from_year:04d}"
+            )
+            filters.append(
+                Activity.start_date_local < f"{self.year_range.to_year + 1:04d}"
+            )
+        return filters
+
     def _filter_tracks(self, tracks):
         filtered_tracks = []
         for t in tracks:
@@ -11,6 +11,7 @@ from datetime import datetime
 from typing import List, Optional, Tuple
 
 import colour
+import numpy as np
 import pytz
 import s2sphere as s2
 
@@ -77,26 +78,81 @@ def project(
     return lines
 
 
+def project_lines(
+    bbox: s2.LatLngRect, size: XY, offset: XY, lines: List[np.ndarray]
+) -> List[np.ndarray]:
+    """Batched project() for (n, 2) arrays of lat, lng degrees, e.g. Track.lines.
+
+    Mercator projection, decimation and bbox clipping are done with NumPy, every
+    returned segment is an (m, 2) array of x, y.
+    """
+    min_x = lng2x(bbox.lng_lo().degrees)
+    d_x = lng2x(bbox.lng_hi().degrees) - min_x
+    while d_x >= 2:
+        d_x -= 2
+    while d_x < 0:
+        d_x += 2
+    min_y = lat2y(bbox.lat_lo().degrees)
+    max_y = lat2y(bbox.lat_hi().degrees)
+    d_y = abs(max_y - min_y)
+    # the distance maybe zero
+    if d_x == 0 or d_y == 0:
+        return []
+    scale = size.x / d_x if size.x / size.y <= d_x / d_y else size.y / d_y
+    offset = offset + 0.5 * (size - scale * XY(d_x, -d_y)) - scale * XY(min_x, min_y)
+    lat_lo, lat_hi = bbox.lat().bounds()
+    lng_lo, lng_hi = bbox.lng().bounds()
+    segments = []
+    # If len > $zoom_threshold, choose 1 point out of every $step to reduce size of the SVG file
+    zoom_threshold = 400
+    for line in lines:
+        step = int(len(line) / zoom_threshold) + 1
+        # same radians round trip as s2.LatLng, so the output matches project()
+        lat = np.radians(line[::step, 0])
+        lng = np.radians(line[::step, 1])
+        inside = (lat >= lat_lo) & (lat <= lat_hi)
+        if bbox.lng().is_inverted():
+            inside &= (lng >= lng_lo) | (lng <= lng_hi)
+        else:
+            inside &= (lng >= lng_lo) & (lng <= lng_hi)
+        xy = np.column_stack(
+            (
+                offset.x + scale * (np.degrees(lng) / 180 + 1),
+                offset.y
+                + scale
+                * (
+                    0.5 - np.log(np.tan(np.pi / 4 * (1 + np.degrees(lat) / 90))) / np.pi
+                ),
+            )
+        )
+        # split where points fall outside the bbox
+        index = np.flatnonzero(inside)
+        for run in np.split(index, np.flatnonzero(np.diff(index) > 1) + 1):
+            if len(run):
+                segments.append(xy[run])
+    return segments
+
+
 def compute_grid(
     count: int, dimensions: XY
 ) -> Tuple[Optional[float], Optional[Tuple[int, int]]]:
-    # this is somehow suboptimal O(count^2). I guess it's possible in O(count)
+    # O(count): for each count_x only the fewest rows that fit all cells can win,
+    # more rows only shrink the cells and add waste
     min_waste = -1.0
     best_size = None
     best_counts = None
     for count_x in range(1, count + 1):
         size_x = dimensions.x / count_x
-        for count_y in range(1, count + 1):
-            if count_x * count_y >= count:
-                size_y = dimensions.y / count_y
-                size = min(size_x, size_y)
-                waste = dimensions.x * dimensions.y - count * size * size
-                if waste < 0:
-                    continue
-                elif best_size is None or waste < min_waste:
-                    best_size = size
-                    best_counts = count_x, count_y
-                    min_waste = waste
+        count_y = -(-count // count_x)
+        size_y = dimensions.y / count_y
+        size = min(size_x, size_y)
+        waste = dimensions.x * dimensions.y - count * size * size
+        if waste < 0:
+            continue
+        elif best_size is None or waste < min_waste:
+            best_size = size
+            best_counts = count_x, count_y
+            min_waste = waste
     return best_size, best_counts
 
 
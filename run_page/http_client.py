@@ -0,0 +1,300 @@
+"""
+Shared HTTP client layer for the sync sources.
+Requests are paced by a token bucket per host instead of fixed sleeps, 429 and
+transient errors are retried with Retry-After or exponential backoff with jitter,
+and every client counts its requests in RequestMetrics.
+AsyncHttpClient wraps httpx.AsyncClient for the async sources, RateLimitedSession
+is a drop-in requests.Session for the blocking ones.
+"""
+
+import asyncio
+import contextlib
+import email.utils
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+
+logger = logging.getLogger(__name__)
+
+# answered with these the request is tried again, 429 also pauses the whole host
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# 5xx and connection errors are only retried for requests that are safe to repeat
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0  # seconds, doubled on every retry
+BACKOFF_CAP = 60.0
+# seconds, requests waits forever for a stalled server without one
+DEFAULT_TIMEOUT = 30
+# failures of the request itself, retried like RETRY_STATUS responses
+TRANSIENT_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+class TokenBucket:
+    """
+    Allow `rate` requests per second on average with bursts of `burst` requests,
+    None as rate means unlimited. A 429 pauses every request of the bucket.
+    """
+
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.resume_at = 0.0
+
+    def reserve(self):
+        """Take a token and return how many seconds to wait before using it"""
+        now = time.monotonic()
+        delay = 0.0
+        if self.rate:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            # tokens may go negative, later callers queue up behind earlier ones
+            self.tokens -= 1
+            if self.tokens < 0:
+                delay = -self.tokens / self.rate
+        return max(delay, self.resume_at - now)
+
+    def pause(self, seconds):
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+
+class RequestMetrics:
+    """Counters of one client, summary() gives a one line report"""
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.errors = 0
+        self.waited = 0.0
+        self.elapsed = 0.0
+        self.by_host = defaultdict(int)
+
+    def summary(self):
+        hosts = ", ".join(f"{h}: {n}" for h, n in sorted(self.by_host.items()))
+        return (
+            f"{self.requests} requests ({hosts}), {self.retries} retries, "
+            f"{self.throttled} throttled, {self.errors} errors, "
+            f"{self.elapsed:.1f}s in requests, {self.waited:.1f}s paced"
+        )
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header, None if missing or invalid"""
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Retry-After if the server sent one, else exponential backoff with jitter"""
+    seconds = parse_retry_after(retry_after)
+    if seconds is not None:
+        return min(seconds, BACKOFF_CAP)
+    delay = min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class _RateLimits:
+    """Token buckets per host, rate_limits maps host to rate or (rate, burst)"""
+
+    def __init__(self, rate_limits=None, default_rate=None, max_retries=MAX_RETRIES):
+        self.rate_limits = rate_limits or {}
+        self.default_rate = default_rate
+        self.max_retries = max_retries
+        self.buckets = {}
+        self.metrics = RequestMetrics()
+
+    def bucket(self, host):
+        if host not in self.buckets:
+            limit = self.rate_limits.get(host, self.default_rate)
+            rate, burst = limit if isinstance(limit, tuple) else (limit, 1)
+            self.buckets[host] = TokenBucket(rate, burst)
+        return self.buckets[host]
+
+    def retry_delay(self, method, attempt, resendable, status=None, retry_after=None):
+        """Seconds to wait before trying again, None if the result is final"""
+        if attempt >= self.max_retries or not resendable:
+            return None
+        if status is not None and status not in RETRY_STATUS:
+            return None
+        if status != 429 and method.upper() not in IDEMPOTENT_METHODS:
+            return None
+        self.metrics.retries += 1
+        return backoff_delay(attempt, retry_after)
+
+
+class AsyncHttpClient(_RateLimits):
+    """
+    httpx.AsyncClient with per-host pacing, retries and metrics.
+    Keyword arguments other than the rate limit ones go to httpx.AsyncClient,
+    attributes that are not defined here (headers, cookies..) are the client's.
+    """
+
+    def __init__(
+        self, rate_limits=None, default_rate=None, max_retries=MAX_RETRIES, **kwargs
+    ):
+        super().__init__(rate_limits, default_rate, max_retries)
+        self.client = httpx.AsyncClient(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    async def _wait(self, host):
+        delay = self.bucket(host).reserve()
+        if delay > 0:
+            self.metrics.waited += delay
+            await asyncio.sleep(delay)
+
+    async def request(self, method, url, **kwargs):
+        host = httpx.URL(url).host
+        # uploaded files are consumed by the first attempt
+        resendable = "files" not in kwargs
+        attempt = 0
+        while True:
+            await self._wait(host)
+            self.metrics.requests += 1
+            self.metrics.by_host[host] += 1
+            start = time.monotonic()
+            try:
+                response = await self.client.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                self.metrics.errors += 1
+                delay = self.retry_delay(method, attempt, resendable)
+                if delay is None:
+                    raise
+                logger.info(f"{method} {url} failed ({e}), retry in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            finally:
+                self.metrics.elapsed += time.monotonic() - start
+            delay = self.retry_delay(
+                method,
+                attempt,
+                resendable,
+                response.status_code,
+                response.headers.get("Retry-After"),
+            )
+            if delay is None:
+                return response
+            if response.status_code == 429:
+                self.metrics.throttled += 1
+                self.bucket(host).pause(delay)
+            else:
+                await asyncio.sleep(delay)
+            logger.info(f"{method} {url} got {response.status_code}, retry")
+            attempt += 1
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def put(self, url, **kwargs):
+        return await self.request("PUT", url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request("DELETE", url, **kwargs)
+
+    @contextlib.asynccontextmanager
+    async def stream(self, method, url, **kwargs):
+        """Paced like request(), but not retried"""
+        host = httpx.URL(url).host
+        await self._wait(host)
+        self.metrics.requests += 1
+        self.metrics.by_host[host] += 1
+        async with self.client.stream(method, url, **kwargs) as response:
+            yield response
+
+    async def aclose(self):
+        logger.info(self.metrics.summary())
+        await self.client.aclose()
+
+
+class RateLimitedSession(requests.Session, _RateLimits):
+    """
+    requests.Session with the same per-host pacing, retries and metrics,
+    the pacing also holds when the session is shared between threads.
+    Requests without a timeout get the timeout of the session.
+    """
+
+    def __init__(
+        self,
+        rate_limits=None,
+        default_rate=None,
+        max_retries=MAX_RETRIES,
+        timeout=DEFAULT_TIMEOUT,
+    ):
+        requests.Session.__init__(self)
+        _RateLimits.__init__(self, rate_limits, default_rate, max_retries)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+    def request(self, method, url, *args, **kwargs):
+        host = urlsplit(url).hostname
+        kwargs.setdefault("timeout", self.timeout)
+        resendable = not kwargs.get("files")
+        attempt = 0
+        while True:
+            with self._lock:
+                delay = self.bucket(host).reserve()
+            if delay > 0:
+                self.metrics.waited += delay
+                time.sleep(delay)
+            self.metrics.requests += 1
+            self.metrics.by_host[host] += 1
+            start = time.monotonic()
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except TRANSIENT_ERRORS as e:
+                self.metrics.errors += 1
+                delay = self.retry_delay(method, attempt, resendable)
+                if delay is None:
+                    raise
+                logger.info(f"{method} {url} failed ({e}), retry in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            finally:
+                self.metrics.elapsed += time.monotonic() - start
+            delay = self.retry_delay(
+                method,
+                attempt,
+                resendable,
+                response.status_code,
+                response.headers.get("Retry-After"),
+            )
+            if delay is None:
+                return response
+            if response.status_code == 429:
+                self.metrics.throttled += 1
+                self.bucket(host).pause(delay)
+            else:
+                time.sleep(delay)
+            logger.info(f"{method} {url} got {response.status_code}, retry")
+            attempt += 1
+
+    def close(self):
+        logger.info(self.metrics.summary())
+        super().close()
@@ -1,8 +1,9 @@
 # some code from https://github.com/fieryd/PKURunningHelper great thanks
 import argparse
-import ast
+import concurrent.futures
 import json
 import os
+import re
 import subprocess
 import sys
 import time
@@ -16,17 +17,57 @@ from xml.etree import ElementTree as etree
 
 import gpxpy
 import polyline
-import requests
 from config import BASE_TIMEZONE, GPX_FOLDER, JSON_FILE, SQL_FILE, run_map, start_point
 from generator import Generator
+from http_client import RateLimitedSession
 
 from utils import adjust_time
 
+try:
+    # run records downloaded at the same time
+    JOYRUN_CONCURRENCY = int(os.getenv("JOYRUN_CONCURRENCY", "5"))
+except ValueError:
+    print("JOYRUN_CONCURRENCY is not a number")
+    exit(1)
+
+# innermost [..] of the point content, one point each
+POINT_PATTERN = re.compile(r"\[([^\[\]]*)\]")
+
 
 def get_md5_data(data):
     return md5(str(data).encode("utf-8")).hexdigest().upper()
 
 
+def parse_number(text):
+    text = text.strip()
+    return int(text) if text.lstrip("-").isdigit() else float(text)
+
+
+def parse_number_list(data_str):
+    """
+    Parse a series like "[120,121.5,-3]" without evaluating it, raises
+    ValueError if it is not a flat list of numbers.
+    """
+    data_str = data_str.strip()
+    if not (data_str.startswith("[") and data_str.endswith("]")):
+        raise ValueError(f"not a list: {data_str[:20]}")
+    values = data_str[1:-1].split(",")
+    # allow a trailing comma and the empty list
+    if not values[-1].strip():
+        values.pop()
+    return [parse_number(v) for v in values]
+
+
+def iter_content_points(content):
+    """
+    Yield [latitude, longitude] of the point content one by one, the content
+    is like [[34132812,-118126177]-[34132813,-118126178]..] in 1e-6 degrees
+    """
+    for match in POINT_PATTERN.finditer(content):
+        values = match.group(1).split(",")
+        yield [parse_number(values[0]) / 1000000, parse_number(values[1]) / 1000000]
+
+
 def download_joyrun_gpx(gpx_data, joyrun_id):
     try:
         print(f"downloading joyrun_id {str(joyrun_id)} gpx")
@@ -102,7 +143,7 @@ class Joyrun:
         self.uid = uid
         self.sid = sid
 
-        self.session = requests.Session()
+        self.session = RateLimitedSession()
 
         self.session.headers.update(self.base_headers)
         self.session.headers.update(self.device_info_headers)
@@ -160,7 +201,7 @@ class Joyrun:
         print(f"your uid and sid are {str(self.uid)} {str(self.sid)}")
         self.__update_loginInfo()
 
-    def get_runs_records_ids(self):
+    def get_runs_records(self):
         payload = {
             "year": 0,  # as of the "year". when set to 2023, it means fetch records during currentYear ~ 2023. set to 0 means fetch all.
         }
@@ -171,27 +212,20 @@ class Joyrun:
         )
         if not r.ok:
             raise Exception("get runs records error")
-        return [i["fid"] for i in r.json()["datas"]]
+        return r.json()["datas"]
+
+    def get_runs_records_ids(self):
+        return [i["fid"] for i in self.get_runs_records()]
 
     @staticmethod
     def parse_content_to_ponits(content):
         if not content:
             return []
         try:
-            # eval is bad but easy maybe change it later
-            # TODO fix this
-            # just an easy way to fix joyrun issue, need to refactor this shit
-            # -[34132812,-118126177]- contains `-` so I just fix it by replace
-            try:
-                points = eval(content.replace("]-[", "],["))
-            except Exception as e:
-                print(str(e))
-                print(f"Points: {str(points)} can not eval")
-            points = [[p[0] / 1000000, p[1] / 1000000] for p in points]
-        except Exception as e:
-            print(str(e))
-            points = []
-        return points
+            return list(iter_content_points(content))
+        except (ValueError, IndexError) as e:
+            print(f"Points: can not parse {content[:50]}: {e}")
+            return []
 
     class Pause:
         def __init__(self, pause_data_point: List[str]):
@@ -203,31 +237,26 @@ class Joyrun:
 
     class PauseList:
         def __init__(self, pause_list: List[List[str]]):
-            self._list = []
-            for pause in pause_list:
-                self._list.append(Joyrun.Pause(pause))
+            self._iter = (Joyrun.Pause(pause) for pause in pause_list)
 
         def next(self) -> "Joyrun.Pause":
-            return self._list.pop(0) if self._list else None
+            return next(self._iter, None)
 
     class DataSeries:
         def __init__(self, data_string: str):
-            self._list = Joyrun.DataSeries._parse(data_string)
+            self._iter = iter(Joyrun.DataSeries._parse(data_string))
 
         def next(self):
-            return self._list.pop(0) if self._list else None
+            return next(self._iter, None)
 
         @staticmethod
         def _parse(data_str):
             if not data_str:
                 return []
             try:
-                parsed = ast.literal_eval(data_str)
-                if isinstance(parsed, list):
-                    return parsed
-                warnings.warn(f'"data" evaluated to {type(parsed)}, want List')
-            except (ValueError, SyntaxError) as e:
-                warnings.warn(f'Failed to evaluate "data": {e}')
+                return parse_number_list(data_str)
+            except ValueError as e:
+                warnings.warn(f'Failed to parse "data": {e}')
             return []
 
     @staticmethod
@@ -340,14 +369,39 @@ class Joyrun:
             "fid": fid,
             "wgs": 1,
         }
+        # an auth of its own, records are fetched from several threads
         r = self.session.post(
             f"{self.base_url}/Run/GetInfo.aspx",
             data=payload,
-            auth=self.auth.reload(payload),
+            auth=JoyrunAuth(self.uid, self.sid).reload(payload),
         )
         data = r.json()
         return data
 
+    def get_single_run_records(self, fids, concurrency=JOYRUN_CONCURRENCY):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return dict(zip(fids, executor.map(self.get_single_run_record, fids)))
+
+    @staticmethod
+    def dedup_runs(runs, threshold):
+        """
+        Keep the longest of the runs starting within threshold seconds of each
+        other, in one sweep over the runs sorted by start time.
+        The first run of a group is its anchor, like the start time keys of
+        the pairwise comparison this replaces.
+        """
+        kept = []
+        anchor = None
+        for run in sorted(runs, key=lambda r: int(r["starttime"])):
+            start_time = int(run["starttime"])
+            if kept and start_time - anchor <= threshold:
+                if float(run["meter"]) > float(kept[-1]["meter"]):
+                    kept[-1] = run
+            else:
+                anchor = start_time
+                kept.append(run)
+        return kept
+
     def parse_raw_data_to_nametuple(self, run_data, old_gpx_ids, with_gpx=False):
         run_data = run_data["runrecord"]
         joyrun_id = run_data["fid"]
@@ -370,12 +424,15 @@ class Joyrun:
             elevation_gain = gpx_data.get_uphill_downhill().uphill
             if with_gpx and str(joyrun_id) not in old_gpx_ids:
                 download_joyrun_gpx(gpx_data.to_xml(), str(joyrun_id))
+        heart_rate_list = None
         try:
             heart_rate_list = (
-                eval(run_data["heartrate"]) if run_data["heartrate"] else None
+                parse_number_list(run_data["heartrate"])
+                if run_data["heartrate"]
+                else None
             )
-        except Exception as e:
-            print(f"Heart Rate: can not eval for {run_data['heartrate']}: {e}")
+        except ValueError as e:
+            print(f"Heart Rate: can not parse {run_data['heartrate']}: {e}")
 
         heart_rate = None
         if heart_rate_list:
@@ -422,35 +479,40 @@ class Joyrun:
         }
         return namedtuple("x", d.keys())(*d.values())
 
-    def get_all_joyrun_tracks(self, old_tracks_ids, with_gpx=False, threshold=10):
-        run_ids = self.get_runs_records_ids()
-        old_tracks_ids = [int(i) for i in old_tracks_ids if i.isdigit()]
+    def get_all_joyrun_tracks(
+        self,
+        old_tracks_ids,
+        with_gpx=False,
+        threshold=10,
+        concurrency=JOYRUN_CONCURRENCY,
+    ):
+        runs = self.get_runs_records()
+        old_tracks_ids = {int(i) for i in old_tracks_ids if i.isdigit()}
 
         old_gpx_ids = os.listdir(GPX_FOLDER)
         old_gpx_ids = [i.split(".")[0] for i in old_gpx_ids if not i.startswith(".")]
-        new_run_ids = list(set(run_ids) - set(old_tracks_ids))
+        new_runs = {r["fid"]: r for r in runs if r["fid"] not in old_tracks_ids}
+        # the run list has the start time and meters to find duplicates,
+        # only runs without them are downloaded before the dedup
+        incomplete = [
+            fid
+            for fid, r in new_runs.items()
+            if "starttime" not in r or "meter" not in r
+        ]
+        records = self.get_single_run_records(incomplete, concurrency)
+        for fid in incomplete:
+            new_runs[fid] = records[fid]["runrecord"]
+        runs = self.dedup_runs(new_runs.values(), threshold)
+        print(f"{len(runs)} new joyrun runs, {len(new_runs) - len(runs)} duplicates")
+        records.update(
+            self.get_single_run_records(
+                [r["fid"] for r in runs if r["fid"] not in records], concurrency
+            )
+        )
         tracks = []
-        seen_runs = {}  # Dictionary to keep track of unique runs with start time as key
-        for i in new_run_ids:
-            run_data = self.get_single_run_record(i)
-            start_time = datetime.fromtimestamp(run_data["runrecord"]["starttime"])
-            distance = run_data["runrecord"]["meter"]
-
-            is_duplicate = False
-            for seen_start in list(seen_runs.keys()):
-                if abs((start_time - seen_start).total_seconds()) <= threshold:
-                    if distance > seen_runs[seen_start]["distance"]:
-                        seen_runs[seen_start] = {
-                            "run_data": run_data,
-                            "distance": distance,
-                        }
-                    is_duplicate = True
-                    break
-            if not is_duplicate:
-                seen_runs[start_time] = {"run_data": run_data, "distance": distance}
-        for run in seen_runs.values():
+        for run in runs:
             track = self.parse_raw_data_to_nametuple(
-                run["run_data"], old_gpx_ids, with_gpx
+                records[run["fid"]], old_gpx_ids, with_gpx
             )
             tracks.append(track)
         return tracks
@@ -564,6 +626,13 @@ if __name__ == "__main__":
         type=int,
         default=10,
     )
+    parser.add_argument(
+        "--concurrency",
+        dest="concurrency",
+        help="number of run records downloaded at the same time",
+        type=int,
+        default=JOYRUN_CONCURRENCY,
+    )
     options = parser.parse_args()
     if options.from_uid_sid:
         j = Joyrun.from_uid_sid(
@@ -580,7 +649,7 @@ if __name__ == "__main__":
     generator = Generator(SQL_FILE)
     old_tracks_ids = generator.get_old_tracks_ids()
     tracks = j.get_all_joyrun_tracks(
-        old_tracks_ids, options.with_gpx, options.threshold
+        old_tracks_ids, options.with_gpx, options.threshold, options.concurrency
     )
     generator.sync_from_app(tracks)
     activities_list = generator.load()
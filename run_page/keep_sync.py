@@ -1,20 +1,22 @@
 import argparse
+import asyncio
 import base64
+import concurrent.futures
 import json
 import os
-import time
 import zlib
 from collections import namedtuple
 from datetime import datetime, timedelta, timezone
 
 import eviltransform
 import gpxpy
+import httpx
 import polyline
-import requests
 from config import GPX_FOLDER, JSON_FILE, SQL_FILE, run_map, start_point
 from Crypto.Cipher import AES
 from generator import Generator
-from utils import adjust_time
+from http_client import AsyncHttpClient
+from utils import adjust_time, nearest_indices
 import xml.etree.ElementTree as ET
 
 KEEP_SPORT_TYPES = ["running", "hiking", "cycling"]
@@ -29,6 +31,15 @@ KEEP2STRAVA = {
 LOGIN_API = "https://api.gotokeep.com/v1.1/users/login"
 RUN_DATA_API = "https://api.gotokeep.com/pd/v3/stats/detail?dateUnit=all&type={sport_type}&lastDate={last_date}"
 RUN_LOG_API = "https://api.gotokeep.com/pd/v3/{sport_type}log/{run_id}"
+TIME_OUT = httpx.Timeout(240.0, connect=360.0)
+try:
+    # run logs fetched at the same time
+    KEEP_CONCURRENCY = int(os.getenv("KEEP_CONCURRENCY", "5"))
+    # spider rule, requests per second to the keep api
+    KEEP_REQUEST_RATE = float(os.getenv("KEEP_REQUEST_RATE", "5"))
+except ValueError:
+    print("KEEP_CONCURRENCY or KEEP_REQUEST_RATE is not a number")
+    exit(1)
 
 HR_FRAME_THRESHOLD_IN_DECISECOND = 100  # Maximum time difference to consider a data point as the nearest, the unit is decisecond(分秒)
 
@@ -38,29 +49,29 @@ TIMESTAMP_THRESHOLD_IN_DECISECOND = 3_600_000  # Threshold for target timestamp
 TRANS_GCJ02_TO_WGS84 = True
 
 
-def login(session, mobile, password):
+async def login(session, mobile, password):
     headers = {
         "User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:78.0) Gecko/20100101 Firefox/78.0",
         "Content-Type": "application/x-www-form-urlencoded;charset=utf-8",
     }
     data = {"mobile": mobile, "password": password}
-    r = session.post(LOGIN_API, headers=headers, data=data)
-    if r.ok:
+    r = await session.post(LOGIN_API, headers=headers, data=data)
+    if r.is_success:
         token = r.json()["data"]["token"]
         headers["Authorization"] = f"Bearer {token}"
         return session, headers
 
 
-def get_to_download_runs_ids(session, headers, sport_type):
+async def get_to_download_runs_ids(session, headers, sport_type):
     last_date = 0
     result = []
 
     while 1:
-        r = session.get(
+        r = await session.get(
             RUN_DATA_API.format(sport_type=sport_type, last_date=last_date),
             headers=headers,
         )
-        if r.ok:
+        if r.is_success:
             run_logs = r.json()["data"]["records"]
 
             for i in run_logs:
@@ -69,17 +80,16 @@ def get_to_download_runs_ids(session, headers, sport_type):
             last_date = r.json()["data"]["lastTimestamp"]
             since_time = datetime.fromtimestamp(last_date / 1000, tz=timezone.utc)
             print(f"pares keep ids data since {since_time}")
-            time.sleep(1)  # spider rule
             if not last_date:
                 break
     return result
 
 
-def get_single_run_data(session, headers, run_id, sport_type):
-    r = session.get(
+async def get_single_run_data(session, headers, run_id, sport_type):
+    r = await session.get(
         RUN_LOG_API.format(sport_type=sport_type, run_id=run_id), headers=headers
     )
-    if r.ok:
+    if r.is_success:
         return r.json()
 
 
@@ -95,12 +105,11 @@ def decode_runmap_data(text, is_geo=False):
     return run_points_data
 
 
-def parse_raw_data_to_nametuple(
-    run_data,
-    old_gpx_ids,
-    session,
-    with_download_gpx=False,
-):
+def parse_raw_data_to_dict(run_data, old_gpx_ids, with_download_gpx=False):
+    """
+    Decode a run log and write its gpx, runs in a worker process.
+    The polyline is returned as a string, run_map tuples can not be pickled.
+    """
     run_data = run_data["data"]
     run_points_data = []
 
@@ -138,7 +147,12 @@ def parse_raw_data_to_nametuple(
                     p["timestamp"] = p["unixTimestamp"]
                 else:
                     p["timestamp"] = 0
-            p_hr = find_nearest_hr(decoded_hr_data, int(p["timestamp"]), start_time)
+        points_hr = find_nearest_hrs(
+            decoded_hr_data,
+            [int(p["timestamp"]) for p in run_points_data_gpx],
+            start_time,
+        )
+        for p, p_hr in zip(run_points_data_gpx, points_hr):
             if p_hr:
                 p["hr"] = p_hr
 
@@ -176,7 +190,7 @@ def parse_raw_data_to_nametuple(
         "end_local": datetime.strftime(end_local, "%Y-%m-%d %H:%M:%S"),
         "length": run_data["distance"],
         "average_heartrate": int(avg_heart_rate) if avg_heart_rate else None,
-        "map": run_map(polyline_str),
+        "map": polyline_str,
         "start_latlng": start_latlng,
         "distance": run_data["distance"],
         "moving_time": timedelta(seconds=run_data["duration"]),
@@ -188,36 +202,103 @@ def parse_raw_data_to_nametuple(
         "location_country": str(run_data.get("region", "")),
         "source": "Keep",
     }
+    return d
+
+
+def dict_to_nametuple(d):
+    d["map"] = run_map(d["map"])
     return namedtuple("x", d.keys())(*d.values())
 
 
-def get_all_keep_tracks(
-    email, password, old_tracks_ids, keep_sports_data_api, with_download_gpx=False
+async def gather_with_concurrency(n, tasks):
+    semaphore = asyncio.Semaphore(n)
+
+    async def sem_task(task):
+        async with semaphore:
+            return await task
+
+    return await asyncio.gather(*(sem_task(task) for task in tasks))
+
+
+async def get_all_keep_tracks_async(
+    email,
+    password,
+    old_tracks_ids,
+    keep_sports_data_api,
+    with_download_gpx=False,
+    concurrency=KEEP_CONCURRENCY,
+    request_rate=KEEP_REQUEST_RATE,
 ):
+    """
+    Fetch run logs concurrently, their decoding and gpx writing runs in a
+    process pool while the next run logs are downloaded.
+    """
     if with_download_gpx and not os.path.exists(GPX_FOLDER):
         os.mkdir(GPX_FOLDER)
-    s = requests.Session()
-    s, headers = login(s, email, password)
+    s = AsyncHttpClient(
+        default_rate=request_rate, timeout=TIME_OUT, follow_redirects=True
+    )
+    loop = asyncio.get_running_loop()
     tracks = []
-    for api in keep_sports_data_api:
-        runs = get_to_download_runs_ids(s, headers, api)
-        runs = [run for run in runs if run.split("_")[1] not in old_tracks_ids]
-        print(f"{len(runs)} new keep {api} data to generate")
-        old_gpx_ids = os.listdir(GPX_FOLDER)
-        old_gpx_ids = [i.split(".")[0] for i in old_gpx_ids if not i.startswith(".")]
-        for run in runs:
-            print(f"parsing keep id {run}")
-            try:
-                run_data = get_single_run_data(s, headers, run, api)
-                track = parse_raw_data_to_nametuple(
-                    run_data, old_gpx_ids, s, with_download_gpx
+    try:
+        s, headers = await login(s, email, password)
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+
+            async def parse_run(run, api, old_gpx_ids):
+                print(f"parsing keep id {run}")
+                try:
+                    run_data = await get_single_run_data(s, headers, run, api)
+                    d = await loop.run_in_executor(
+                        executor,
+                        parse_raw_data_to_dict,
+                        run_data,
+                        old_gpx_ids,
+                        with_download_gpx,
+                    )
+                    return dict_to_nametuple(d) if d else None
+                except Exception as e:
+                    print(f"Something wrong paring keep id {run}" + str(e))
+
+            for api in keep_sports_data_api:
+                runs = await get_to_download_runs_ids(s, headers, api)
+                runs = [run for run in runs if run.split("_")[1] not in old_tracks_ids]
+                print(f"{len(runs)} new keep {api} data to generate")
+                old_gpx_ids = os.listdir(GPX_FOLDER)
+                old_gpx_ids = {
+                    i.split(".")[0] for i in old_gpx_ids if not i.startswith(".")
+                }
+                api_tracks = await gather_with_concurrency(
+                    concurrency, [parse_run(run, api, old_gpx_ids) for run in runs]
                 )
-                tracks.append(track)
-            except Exception as e:
-                print(f"Something wrong paring keep id {run}" + str(e))
+                tracks.extend(t for t in api_tracks if t)
+        print(s.metrics.summary())
+    finally:
+        await s.aclose()
     return tracks
 
 
+def get_all_keep_tracks(
+    email,
+    password,
+    old_tracks_ids,
+    keep_sports_data_api,
+    with_download_gpx=False,
+    concurrency=KEEP_CONCURRENCY,
+    request_rate=KEEP_REQUEST_RATE,
+):
+    return asyncio.run(
+        get_all_keep_tracks_async(
+            email,
+            password,
+            old_tracks_ids,
+            keep_sports_data_api,
+            with_download_gpx,
+            concurrency,
+            request_rate,
+        )
+    )
+
+
 def parse_points_to_gpx(run_points_data, start_time, sport_type):
     """
     Convert run points data to GPX format.
@@ -297,28 +378,32 @@ def find_nearest_hr(
     Returns:
         int or None: The heart rate value of the nearest data point, or None if no suitable data point is found.
     """
-    closest_element = None
-    # init difference value
-    min_difference = float("inf")
-    if target_time > TIMESTAMP_THRESHOLD_IN_DECISECOND:
-        target_time = (
-            target_time * 100 - start_time
-        ) / 100  # note that the unit of target_time is decisecond and the unit of start_time is normal millisecond
+    return find_nearest_hrs(hr_data_list, [target_time], start_time, threshold)[0]
 
-    for item in hr_data_list:
-        timestamp = item["timestamp"]
-        difference = abs(timestamp - target_time)
 
-        if difference <= threshold and difference < min_difference:
-            closest_element = item
-            min_difference = difference
-
-    if closest_element:
-        hr = closest_element.get("beatsPerMinute")
-        if hr and hr > 0:
-            return hr
+def find_nearest_hrs(
+    hr_data_list, target_times, start_time, threshold=HR_FRAME_THRESHOLD_IN_DECISECOND
+):
+    """
+    find_nearest_hr for all points of a run at once, in O((points + hr) log hr)
+    instead of scanning hr_data_list for every point.
 
-    return None
+    Returns:
+        list of int or None: The heart rate for every target time.
+    """
+    # note that the unit of target_time is decisecond and the unit of start_time is normal millisecond
+    target_times = [
+        (t * 100 - start_time) / 100 if t > TIMESTAMP_THRESHOLD_IN_DECISECOND else t
+        for t in target_times
+    ]
+    indices = nearest_indices(
+        [item["timestamp"] for item in hr_data_list], target_times, threshold
+    )
+    result = []
+    for i in indices:
+        hr = hr_data_list[i].get("beatsPerMinute") if i is not None else None
+        result.append(hr if hr and hr > 0 else None)
+    return result
 
 
 def download_keep_gpx(gpx_data, keep_id):
@@ -334,11 +419,24 @@ def download_keep_gpx(gpx_data, keep_id):
         pass
 
 
-def run_keep_sync(email, password, keep_sports_data_api, with_download_gpx=False):
+def run_keep_sync(
+    email,
+    password,
+    keep_sports_data_api,
+    with_download_gpx=False,
+    concurrency=KEEP_CONCURRENCY,
+    request_rate=KEEP_REQUEST_RATE,
+):
     generator = Generator(SQL_FILE)
     old_tracks_ids = generator.get_old_tracks_ids()
     new_tracks = get_all_keep_tracks(
-        email, password, old_tracks_ids, keep_sports_data_api, with_download_gpx
+        email,
+        password,
+        old_tracks_ids,
+        keep_sports_data_api,
+        with_download_gpx,
+        concurrency,
+        request_rate,
     )
     generator.sync_from_app(new_tracks)
 
@@ -364,11 +462,30 @@ if __name__ == "__main__":
         action="store_true",
         help="get all keep data to gpx and download",
     )
+    parser.add_argument(
+        "--concurrency",
+        dest="concurrency",
+        type=int,
+        default=KEEP_CONCURRENCY,
+        help="number of run logs downloaded at the same time",
+    )
+    parser.add_argument(
+        "--request-rate",
+        dest="request_rate",
+        type=float,
+        default=KEEP_REQUEST_RATE,
+        help="maximum requests per second to the keep api",
+    )
     options = parser.parse_args()
     for _tpye in options.sync_types:
         assert (
             _tpye in KEEP_SPORT_TYPES
         ), f"{_tpye} are not supported type, please make sure that the type entered in the {KEEP_SPORT_TYPES}"
     run_keep_sync(
-        options.phone_number, options.password, options.sync_types, options.with_gpx
+        options.phone_number,
+        options.password,
+        options.sync_types,
+        options.with_gpx,
+        options.concurrency,
+        options.request_rate,
     )
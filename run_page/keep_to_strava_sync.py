@@ -34,7 +34,7 @@ def run_keep_sync(email, password, keep_sports_data_api, with_download_gpx=False
             except json.JSONDecodeError as e:
                 print(f"Error reading JSON file {KEEP2STRAVA_BK_PATH}: {e}")
                 content = []
-    old_tracks_ids = [str(a["run_id"]) for a in content]
+    old_tracks_ids = {str(a["run_id"]) for a in content}
     _new_tracks = get_all_keep_tracks(
         email, password, old_tracks_ids, keep_sports_data_api, True
     )
@@ -8,7 +8,6 @@ from datetime import datetime, timedelta, timezone
 from xml.etree import ElementTree
 
 import gpxpy.gpx
-import httpx
 from config import (
     BASE_TIMEZONE,
     GPX_FOLDER,
@@ -18,6 +17,7 @@ from config import (
     run_map,
 )
 from generator import Generator
+from http_client import RateLimitedSession
 
 from utils import adjust_time, make_activities_file
 
@@ -26,35 +26,25 @@ logger = logging.getLogger("nike_sync")
 
 BASE_URL = "https://api.nike.com/plus/v3"
 TOKEN_REFRESH_URL = "https://api.nike.com/idn/shim/oauth/2.0/token"
+NIKE_TIMEOUT = 10  # seconds per connect or read, activities with all metrics are big
 
 
 class Nike:
     def __init__(self, access_token):
-        self.client = httpx.Client()
+        # timeouts, connection errors, 5xx and 429 are retried by the session
+        self.client = RateLimitedSession(timeout=NIKE_TIMEOUT)
 
         self.client.headers.update({"Authorization": f"Bearer {access_token}"})
 
     def get_activities_before_id(self, activity_id):
         if not activity_id:
             activity_id = "*"
-        try:
-            return self.request(
-                f"activities/before_id/v3/{activity_id}?limit=30&types=run%2Cjogging&include_deleted=false"
-            )
-        except Exception as e:
-            print(f"Error getting activities before id {activity_id}: {e}")
-            time.sleep(3)
-            return self.request(
-                f"activities/before_id/v3/{activity_id}?limit=30&types=run%2Cjogging&include_deleted=false"
-            )
+        return self.request(
+            f"activities/before_id/v3/{activity_id}?limit=30&types=run%2Cjogging&include_deleted=false"
+        )
 
     def get_activity(self, activity_id):
-        try:
-            return self.request(f"activity/{activity_id}?metrics=ALL")
-        except Exception:
-            print("retry")
-            time.sleep(3)
-            return self.request(f"activity/{activity_id}?metrics=ALL")
+        return self.request(f"activity/{activity_id}?metrics=ALL")
 
     def request(self, resource):
         url = f"{BASE_URL}/{resource}"
@@ -2,7 +2,6 @@ import argparse
 import hashlib
 import json
 import os
-import time
 import xml.etree.ElementTree as ET
 from collections import namedtuple
 from datetime import datetime, timedelta, timezone
@@ -10,7 +9,6 @@ from xml.dom import minidom
 
 import gpxpy
 import polyline
-import requests
 from tzlocal import get_localzone
 
 from config import (
@@ -23,9 +21,12 @@ from config import (
     UTC_TIMEZONE,
 )
 from generator import Generator
+from http_client import RateLimitedSession
 from utils import adjust_time
 
 TOKEN_REFRESH_URL = "https://sport.health.heytapmobi.com/open/v1/oauth/token"
+# spider rule, requests per second to the oppo api
+OPPO_REQUEST_RATE = 1
 
 # Query brief version of sports records
 # The query range cannot exceed one month!
@@ -159,7 +160,6 @@ def parse_brief_sport_data(session, headers, temp_start, temp_end):
             ):
                 result.append((i["startTime"], i["endTime"]))
                 print("sync record: start_time: " + str(i["startTime"]))
-        time.sleep(1)  # spider rule
     return result
 
 
@@ -261,7 +261,7 @@ def get_all_oppo_tracks(
 ):
     if with_download_gpx and not os.path.exists(GPX_FOLDER):
         os.mkdir(GPX_FOLDER)
-    s = requests.Session()
+    s = RateLimitedSession(default_rate=OPPO_REQUEST_RATE)
     s, headers = get_access_token(s, client_id, client_secret, refresh_token)
 
     last_timestamp = (
@@ -395,50 +395,66 @@ def prepare_track_points(sport_data, with_gpx):
         points_dict_list (list): data with need to parse.
     """
     other_data = sport_data["otherSportData"]
-    decoded_hr_data = other_data.get("heartRate", None)
+    hr_data = other_data.get("heartRate", None)
+    hr_values = [item["value"] for item in hr_data] if hr_data else []
+    # the sensor series share the index of the heart rate series
+    series = get_value_series(other_data)
     points_dict_list = []
 
     if other_data.get("gpsPoint"):
-        timestamp_list = [item["timestamp"] for item in decoded_hr_data]
-        other_data = sport_data["otherSportData"]
-        value_size = len(other_data.get("gpsPoint", None))
-
-        for i in range(value_size):
-            temp_timestamp = other_data.get("gpsPoint")[i]["timestamp"]
-            j = timestamp_list.index(temp_timestamp)
+        gps_points = other_data["gpsPoint"]
+        # each gps point is joined to the first heart rate sample with its timestamp
+        hr_index = {}
+        for i, item in enumerate(hr_data):
+            hr_index.setdefault(item["timestamp"], i)
+
+        for point in gps_points:
+            temp_timestamp = point["timestamp"]
+            j = hr_index.get(temp_timestamp)
+            if j is None:
+                raise ValueError(f"{temp_timestamp} is not in heart rate data")
 
             points_dict = {
-                "latitude": other_data.get("gpsPoint")[i]["latitude"],
-                "longitude": other_data.get("gpsPoint")[i]["longitude"],
+                "latitude": point["latitude"],
+                "longitude": point["longitude"],
                 "time": datetime.fromtimestamp(temp_timestamp / 1000, tz=timezone.utc),
-                "hr": other_data.get("heartRate")[j]["value"],
+                "hr": hr_values[j],
             }
-            points_dict_list.append(get_value(j, points_dict, other_data))
+            points_dict_list.append(get_value(j, points_dict, series))
     elif with_gpx is False:
-        value_size = len(other_data.get("heartRate", None))
-
-        for i in range(value_size):
-            temp_timestamp = other_data.get("heartRate")[i]["timestamp"]
-            temp_date = datetime.fromtimestamp(temp_timestamp / 1000, tz=timezone.utc)
+        for i, item in enumerate(hr_data):
+            temp_date = datetime.fromtimestamp(
+                item["timestamp"] / 1000, tz=timezone.utc
+            )
             points_dict = {
                 "time": temp_date,
-                "hr": other_data.get("heartRate")[i]["value"],
+                "hr": hr_values[i],
             }
-            points_dict_list.append(get_value(i, points_dict, other_data))
+            points_dict_list.append(get_value(i, points_dict, series))
 
     return points_dict_list
 
 
-def get_value(index, points_dict, other_data):
+def get_value_series(other_data):
+    """Values of the optional sensor series, keyed by their points_dict name."""
+    series = {}
     if other_data.get("pace"):
-        pace = other_data.get("pace")[index]["value"]
-        points_dict["speed"] = 0 if pace == 0 else 1000 / pace
+        series["speed"] = [
+            0 if item["value"] == 0 else 1000 / item["value"]
+            for item in other_data["pace"]
+        ]
     if other_data.get("frequency"):
-        points_dict["cad"] = other_data.get("frequency")[index]["value"]
+        series["cad"] = [item["value"] for item in other_data["frequency"]]
     if other_data.get("distance"):
-        points_dict["distance"] = other_data.get("distance")[index]["value"]
+        series["distance"] = [item["value"] for item in other_data["distance"]]
     if other_data.get("elevation"):
-        points_dict["elevation"] = other_data.get("elevation")[index]["value"]
+        series["elevation"] = [item["value"] for item in other_data["elevation"]]
+    return series
+
+
+def get_value(index, points_dict, series):
+    for name, values in series.items():
+        points_dict[name] = values[index]
     return points_dict
 
 
@@ -1,7 +1,12 @@
+import atexit
+import hashlib
+import json
+from collections import OrderedDict
 from typing import List, Tuple
+import numpy as np
 import polyline
 import os
-from haversine import haversine
+from config import FILTER_CACHE_FILE
 
 try:
     IGNORE_POLYLINE = (
@@ -20,45 +25,60 @@ except ValueError:
     print("IGNORE_RANGE or IGNORE_START_END_RANGE is not a number")
     exit(1)
 
+try:
+    # max number of polylines kept in the filter_out cache, 0 disables it
+    FILTER_CACHE_SIZE = int(os.getenv("FILTER_CACHE_SIZE", "20000"))
+except ValueError:
+    print("FILTER_CACHE_SIZE is not a number")
+    exit(1)
+
 
-def point_distance_in_range(
-    point: Tuple[float], center_point: Tuple[float], distance: int
-) -> bool:
-    return haversine(point, center_point) < distance
+# same radius and formula as haversine.haversine, so results match it exactly
+EARTH_RADIUS = 6371.0088
 
 
-def point_in_list_points_range(
-    point: Tuple[float], points: List[Tuple[float]], distance: int
-) -> bool:
-    return any([point_distance_in_range(point, p, distance) for p in points])
+def haversine_vector(lat1, lng1, lat2, lng2) -> np.ndarray:
+    """Great-circle distance in km, broadcasting over numpy arrays of degrees."""
+    lat1 = np.radians(lat1)
+    lng1 = np.radians(lng1)
+    lat2 = np.radians(lat2)
+    lng2 = np.radians(lng2)
+    lat = lat2 - lat1
+    lng = lng2 - lng1
+    d = np.sin(lat * 0.5) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(lng * 0.5) ** 2
+    return EARTH_RADIUS * (2 * np.arcsin(np.sqrt(d)))
 
 
 def range_hiding(
     polyline: List[Tuple[float]], points: List[Tuple[float]], distance: int
 ) -> List[Tuple[float]]:
-    return [
-        point
-        for point in polyline
-        if not point_in_list_points_range(point, points, distance)
-    ]
+    if not polyline or not points:
+        return list(polyline)
+    pl = np.asarray(polyline, dtype=float)
+    ps = np.asarray(points, dtype=float)
+    # distances of every point to every ignored point in one broadcast
+    distances = haversine_vector(
+        pl[:, 0, None], pl[:, 1, None], ps[None, :, 0], ps[None, :, 1]
+    )
+    hidden = (distances < distance).any(axis=1)
+    return [point for point, h in zip(polyline, hidden) if not h]
 
 
 def start_end_hiding(polyline: List[Tuple[float]], distance: int) -> List[Tuple[float]]:
     start_index, end_index = 0, len(polyline) - 1
+    if len(polyline) > 1:
+        pl = np.asarray(polyline, dtype=float)
+        steps = haversine_vector(pl[1:, 0], pl[1:, 1], pl[:-1, 0], pl[:-1, 1])
 
-    starting_distance = 0
-    for i in range(1, len(polyline)):
-        starting_distance += haversine(polyline[i], polyline[i - 1])
-        if starting_distance > distance:
-            start_index = i
-            break
+        # first point where the distance walked from the start exceeds the range
+        over = np.flatnonzero(np.cumsum(steps) > distance)
+        if over.size:
+            start_index = int(over[0]) + 1
 
-    ending_distance = 0
-    for i in range(len(polyline) - 2, -1, -1):
-        ending_distance += haversine(polyline[i], polyline[i + 1])
-        if ending_distance > distance:
-            end_index = i
-            break
+        # same walking backwards from the end
+        over = np.flatnonzero(np.cumsum(steps[::-1]) > distance)
+        if over.size:
+            end_index = len(polyline) - 2 - int(over[0])
 
     if start_index >= end_index:
         return []
@@ -66,9 +86,7 @@ def start_end_hiding(polyline: List[Tuple[float]], distance: int) -> List[Tuple[
     return polyline[start_index : end_index + 1]
 
 
-def filter_out(polyline_str):
-    if not polyline_str:
-        return
+def _filter_out(polyline_str):
     pl = polyline.decode(polyline_str)
     if not pl:
         return polyline_str
@@ -79,3 +97,69 @@ def filter_out(polyline_str):
     if not new_pl:
         return
     return polyline.encode(new_pl)
+
+
+class FilterCache:
+    """Persistent, size-bounded LRU cache of filter_out results.
+
+    Entries are keyed by the sha1 of the input polyline. The file also stores a
+    fingerprint of the privacy settings, so changing IGNORE_POLYLINE,
+    IGNORE_RANGE or IGNORE_START_END_RANGE drops every cached result.
+    """
+
+    def __init__(self, cache_file, max_size):
+        self.cache_file = cache_file
+        self.max_size = max_size
+        self.settings = hashlib.sha1(
+            json.dumps([IGNORE_POLYLINE, IGNORE_RANGE, IGNORE_START_END_RANGE]).encode()
+        ).hexdigest()
+        self.entries = self._load()
+        self.dirty = False
+
+    def _load(self):
+        if not os.path.exists(self.cache_file):
+            return OrderedDict()
+        with open(self.cache_file, "r") as f:
+            try:
+                data = json.load(f)
+            except Exception as e:
+                print(f"json load {self.cache_file} \nerror {e}")
+                return OrderedDict()
+        if data.get("settings") != self.settings:
+            return OrderedDict()
+        return OrderedDict(data.get("polylines", {}))
+
+    def filter_out(self, polyline_str):
+        key = hashlib.sha1(polyline_str.encode()).hexdigest()
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        result = _filter_out(polyline_str)
+        self.entries[key] = result
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        self.dirty = True
+        return result
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        with open(self.cache_file, "w") as f:
+            json.dump({"settings": self.settings, "polylines": self.entries}, f)
+        self.dirty = False
+
+
+_filter_cache = None
+
+
+def filter_out(polyline_str):
+    global _filter_cache
+    if not polyline_str:
+        return
+    if FILTER_CACHE_SIZE <= 0:
+        return _filter_out(polyline_str)
+    if _filter_cache is None:
+        _filter_cache = FilterCache(FILTER_CACHE_FILE, FILTER_CACHE_SIZE)
+        atexit.register(_filter_cache.save)
+    return _filter_cache.filter_out(polyline_str)
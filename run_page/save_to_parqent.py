@@ -4,8 +4,11 @@ with duckdb.connect() as conn:
     conn.install_extension("sqlite")
     conn.load_extension("sqlite")
     conn.sql("ATTACH 'run_page/data.db' (TYPE SQLITE);USE data;")
+    # the columns of activities before the routes were moved to activity_routes,
+    # without the epoch copy of start_date that is only used for queries
     conn.sql(
-        "COPY (SELECT * FROM activities) TO 'run_page/data.parquet' (FORMAT PARQUET);"
+        "COPY (SELECT * EXCLUDE (start_date_epoch) FROM activities_with_polyline) "
+        "TO 'run_page/data.parquet' (FORMAT PARQUET);"
     )
 
 """
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the scripts import each other from run_page, like `python run_page/x.py`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
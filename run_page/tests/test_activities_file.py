@@ -0,0 +1,161 @@
+import datetime
+import json
+from collections import namedtuple
+
+import polyline
+import pytest
+
+import generator
+import polyline_processor
+from config import run_map
+from generator import Generator
+from generator.db import Activity
+
+START = datetime.datetime(2024, 3, 1, 7, 0)
+
+
+def _activity(run_id, day, hour=0, type="Run", distance=5000.0):
+    start = START + datetime.timedelta(days=day, hours=hour)
+    route = [(39.9 + run_id * 1e-3 + i * 1e-3, 116.3 + i * 1e-3) for i in range(30)]
+    d = {
+        "id": run_id,
+        "name": f"run {run_id}",
+        "type": type,
+        "start_date": start.strftime("%Y-%m-%d %H:%M:%S"),
+        "start_date_local": start.strftime("%Y-%m-%d %H:%M:%S"),
+        "distance": distance,
+        "moving_time": datetime.timedelta(minutes=30),
+        "elapsed_time": datetime.timedelta(minutes=32),
+        "average_heartrate": 150.0,
+        "average_speed": distance / 1800,
+        "elevation_gain": 12.0,
+        "map": run_map(polyline.encode(route)),
+        "start_latlng": None,
+        "location_country": "",
+        "source": "test",
+    }
+    return namedtuple("x", d.keys())(*d.values())
+
+
+# consecutive days for streaks, a gap, two runs on one day and a walk
+ACTIVITIES = [
+    _activity(i, day)
+    for i, day in enumerate([0, 1, 2, 5, 6, 6, 9, 10, 11, 12, 20, 21], start=1)
+] + [_activity(13, 7, type="Walk")]
+
+
+@pytest.fixture(autouse=True)
+def _settings(monkeypatch):
+    # hide the route ends so filtered polylines differ from the stored ones,
+    # and keep the filter cache out of the repo's .cache
+    monkeypatch.setattr(polyline_processor, "IGNORE_START_END_RANGE", 0.2)
+    monkeypatch.setattr(polyline_processor, "FILTER_CACHE_SIZE", 0)
+    monkeypatch.setattr(generator, "IGNORE_BEFORE_SAVING", False)
+
+
+@pytest.fixture
+def synced(tmp_path):
+    """A generator with ACTIVITIES synced and a fully written json file."""
+    g = Generator(str(tmp_path / "data.db"))
+    g.sync_from_app(ACTIVITIES)
+    json_file = str(tmp_path / "activities.json")
+    g.write_activities_file(json_file)
+    return g, json_file
+
+
+def _expected(g, for_mapping=False):
+    return json.dumps(g.loadForMapping() if for_mapping else g.load(), indent=0)
+
+
+def _read(json_file):
+    with open(json_file) as f:
+        return f.read()
+
+
+def _rewrote(capsys):
+    return "Rewrote" in capsys.readouterr().out
+
+
+def test_full_write_is_json_dump_of_load(synced):
+    g, json_file = synced
+    assert _read(json_file) == _expected(g)
+
+
+def test_sync_rewrites_the_tail_from_the_changed_day(synced, capsys):
+    g, json_file = synced
+    capsys.readouterr()
+    # a new run the day after day 11 continues its streak, an update of a
+    # later run and a new latest run
+    g.sync_from_app([_activity(20, 12, hour=5), _activity(10, 12, distance=8000.0)])
+    g.sync_from_app([_activity(21, 30)])
+    g.write_activities_file(json_file)
+    assert _rewrote(capsys)
+    assert _read(json_file) == _expected(g)
+    assert not g.changed_run_ids
+
+
+def test_mapping_file_rewrites_the_tail(tmp_path, capsys):
+    g = Generator(str(tmp_path / "data.db"))
+    g.sync_from_app(ACTIVITIES)
+    json_file = str(tmp_path / "activities.json")
+    g.write_activities_file(json_file, for_mapping=True)
+    g.sync_from_app([_activity(20, 21, hour=3)])
+    g.write_activities_file(json_file, for_mapping=True)
+    assert _rewrote(capsys)
+    assert _read(json_file) == _expected(g, for_mapping=True)
+
+
+def test_full_regenerates_the_file(synced, capsys):
+    g, json_file = synced
+    g.sync_from_app([_activity(20, 21, hour=3)])
+    g.write_activities_file(json_file, full=True)
+    assert not _rewrote(capsys)
+    assert _read(json_file) == _expected(g)
+
+
+def test_head_count_mismatch_regenerates_the_file(synced, capsys):
+    g, json_file = synced
+    # added before the changed day by something else than this generator
+    other = Generator(g.session.bind.url.database)
+    other.sync_from_app([_activity(30, 3)])
+    g.sync_from_app([_activity(20, 21, hour=3)])
+    g.write_activities_file(json_file)
+    assert not _rewrote(capsys)
+    assert _read(json_file) == _expected(g)
+
+
+def test_changed_previous_activity_regenerates_the_file(synced, capsys):
+    g, json_file = synced
+    g.session.query(Activity).filter(Activity.run_id == 11).update({"name": "renamed"})
+    g.session.commit()
+    g.sync_from_app([_activity(20, 21, hour=3)])
+    g.write_activities_file(json_file)
+    assert not _rewrote(capsys)
+    assert _read(json_file) == _expected(g)
+
+
+def test_changed_only_run_regenerates_the_file(synced, capsys):
+    g, json_file = synced
+    g.only_run = True
+    # the walk in the head is in the file but not exported with only_run
+    g.sync_from_app([_activity(20, 21, hour=3)])
+    g.write_activities_file(json_file)
+    assert not _rewrote(capsys)
+    assert _read(json_file) == _expected(g)
+
+
+def test_changed_ignore_before_saving_regenerates_the_file(synced, capsys, monkeypatch):
+    g, json_file = synced
+    monkeypatch.setattr(generator, "IGNORE_BEFORE_SAVING", True)
+    g.sync_from_app([_activity(20, 21, hour=3)])
+    g.write_activities_file(json_file)
+    assert not _rewrote(capsys)
+    assert _read(json_file) == _expected(g)
+
+
+def test_file_of_the_other_mode_is_regenerated(synced, capsys):
+    g, json_file = synced
+    g.sync_from_app([_activity(20, 21, hour=3)])
+    g.write_activities_file(json_file, for_mapping=True)
+    assert not _rewrote(capsys)
+    assert _read(json_file) == _expected(g, for_mapping=True)
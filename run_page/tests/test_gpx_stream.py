@@ -0,0 +1,79 @@
+import datetime
+import math
+
+import pytest
+
+from gpxtrackposter.track import Track
+
+GPX_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<gpx version="1.1" creator="test" xmlns="http://www.topografix.com/GPX/1/1"'
+    ' xmlns:ns3="http://www.garmin.com/xmlschemas/TrackPointExtension/v1">'
+)
+
+
+def _point(i, start, time=True, elevation=True, heart_rate=True, utc_offset="Z"):
+    # a wiggly line so simplify keeps some of the points but not all
+    latitude = 30 + i * 0.0001 + math.sin(i / 7) * 0.0002
+    longitude = 120 + i * 0.00012
+    point = f'<trkpt lat="{latitude:.7f}" lon="{longitude:.7f}">'
+    if elevation:
+        point += f"<ele>{10 + math.cos(i / 5) * 4:.1f}</ele>"
+    if time:
+        # pauses every 50 points for the moving time threshold
+        t = start + datetime.timedelta(seconds=3 * i + 60 * (i // 50))
+        point += f"<time>{t.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]}{utc_offset}</time>"
+    if heart_rate:
+        point += (
+            "<extensions><ns3:TrackPointExtension>"
+            f"<ns3:hr>{0 if i % 11 == 0 else 120 + i % 40}</ns3:hr>"
+            "</ns3:TrackPointExtension></extensions>"
+        )
+    return point + "</trkpt>"
+
+
+def _segment(points):
+    return "<trkseg>" + "".join(points) + "</trkseg>"
+
+
+START = datetime.datetime(2024, 5, 1, 6, 30)
+
+GPX_FILES = {
+    "one_segment": GPX_HEAD
+    + "<trk><name>Morning</name><type>running</type>"
+    + _segment(_point(i, START) for i in range(300))
+    + "</trk></gpx>",
+    "segments_and_tracks": GPX_HEAD
+    + "<metadata><name>Two tracks</name></metadata>"
+    + "<trk><type>running</type>"
+    + _segment(_point(i, START) for i in range(200))
+    + _segment([])
+    + _segment(_point(i, START) for i in range(260, 400))
+    + "</trk><trk>"
+    + _segment(_point(i, START, utc_offset="+08:00") for i in range(400, 500))
+    + "</trk></gpx>",
+    "missing_values": GPX_HEAD
+    + "<trk>"
+    + _segment(
+        _point(i, START, elevation=i % 3 != 0, heart_rate=i % 2 == 0)
+        for i in range(250)
+    )
+    + _segment(_point(i, START, time=i != 20) for i in range(300, 400))
+    + "</trk></gpx>",
+}
+
+
+@pytest.mark.parametrize("name", GPX_FILES)
+def test_stream_loads_the_same_track_as_gpxpy(tmp_path, name):
+    gpx_file = tmp_path / f"{name}.gpx"
+    gpx_file.write_text(GPX_FILES[name], encoding="utf-8")
+    expected = Track()
+    expected.load_gpx(str(gpx_file), stream=False)
+    track = Track()
+    track.load_gpx(str(gpx_file), stream=True)
+
+    assert expected.start_time is not None
+    assert track.to_namedtuple() == expected.to_namedtuple()
+    assert [line.tolist() for line in track.lines] == [
+        line.tolist() for line in expected.lines
+    ]
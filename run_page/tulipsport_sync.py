@@ -6,9 +6,9 @@ from datetime import datetime, timedelta, timezone
 from urllib.parse import quote
 import gpxpy
 import polyline
-import requests
 from config import GPX_FOLDER, JSON_FILE, SQL_FILE, run_map, start_point
 from generator import Generator
+from http_client import RateLimitedSession
 from xml.etree import ElementTree
 from utils import adjust_time_to_utc
 
@@ -163,7 +163,7 @@ def find_last_tulipsport_start_time(track_ids):
 
 
 def get_new_activities(token, old_tracks_ids, with_gpx=False):
-    s = requests.Session()
+    s = RateLimitedSession()
     headers = {"Authorization": token}
     activity_summary_list = get_all_activity_summaries(
         s, headers, find_last_tulipsport_start_time(old_tracks_ids)
@@ -1,7 +1,7 @@
-import json
 import time
 from datetime import datetime
 
+import numpy as np
 import pytz
 
 try:
@@ -48,28 +48,65 @@ def to_date(ts):
     raise ValueError(f"cannot parse timestamp {ts} into date with fmts: {ts_fmts}")
 
 
+def nearest_indices(timestamps, targets, threshold):
+    """
+    Index of the nearest of timestamps for every target, None if none is within
+    threshold. Sorts timestamps once and bisects, instead of scanning them for
+    every target. Ties go to the lower index, like a scan keeping the first
+    strictly smaller difference. Used to merge heart rate streams into tracks.
+    """
+    if len(timestamps) == 0:
+        return [None] * len(targets)
+    timestamps = np.asarray(timestamps, dtype=float)
+    targets = np.asarray(targets, dtype=float)
+    order = np.argsort(timestamps, kind="stable")
+    ordered = timestamps[order]
+    last = len(ordered) - 1
+    # first timestamp at or after the target
+    right = np.minimum(np.searchsorted(ordered, targets, "left"), last)
+    # first of the timestamps equal to the last one at or before the target
+    left = np.maximum(np.searchsorted(ordered, targets, "right") - 1, 0)
+    left = np.searchsorted(ordered, ordered[left], "left")
+    left_diff = np.abs(ordered[left] - targets)
+    right_diff = np.abs(ordered[right] - targets)
+    left_index = order[left]
+    right_index = order[right]
+    use_left = (left_diff < right_diff) | (
+        (left_diff == right_diff) & (left_index < right_index)
+    )
+    index = np.where(use_left, left_index, right_index)
+    diff = np.where(use_left, left_diff, right_diff)
+    return [int(i) if d <= threshold else None for i, d in zip(index, diff)]
+
+
 def make_activities_file(
-    sql_file, data_dir, json_file, file_suffix="gpx", activity_title_dict={}
+    sql_file,
+    data_dir,
+    json_file,
+    file_suffix="gpx",
+    activity_title_dict={},
+    full=False,
 ):
     generator = Generator(sql_file)
     generator.sync_from_data_dir(
         data_dir, file_suffix=file_suffix, activity_title_dict=activity_title_dict
     )
-    activities_list = generator.load()
-    with open(json_file, "w") as f:
-        json.dump(activities_list, f, indent=0)
+    generator.write_activities_file(json_file, full=full)
 
 
 def make_activities_file_only(
-    sql_file, data_dir, json_file, file_suffix="gpx", activity_title_dict={}
+    sql_file,
+    data_dir,
+    json_file,
+    file_suffix="gpx",
+    activity_title_dict={},
+    full=False,
 ):
     generator = Generator(sql_file)
     generator.sync_from_data_dir(
         data_dir, file_suffix=file_suffix, activity_title_dict=activity_title_dict
     )
-    activities_list = generator.loadForMapping()
-    with open(json_file, "w") as f:
-        json.dump(activities_list, f, indent=0)
+    generator.write_activities_file(json_file, for_mapping=True, full=full)
 
 
 def make_strava_client(client_id, client_secret, refresh_token):
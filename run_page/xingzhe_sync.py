@@ -10,11 +10,11 @@ from datetime import datetime
 import aiofiles
 import bs4
 import gpxpy as mod_gpxpy
-import requests
 from config import GPX_FOLDER, JSON_FILE, SQL_FILE
 from Crypto.Cipher import PKCS1_v1_5
 from Crypto.PublicKey import RSA
 from generator import Generator
+from http_client import RateLimitedSession
 
 from utils import make_activities_file
 
@@ -66,7 +66,7 @@ class Xingzhe:
         self.session_id = session_id
         self.user_id = user_id
 
-        self.session = requests.Session()
+        self.session = RateLimitedSession()
         self.session.headers.update(device_info_headers())
         if session_id:
             self.session.headers.update({"Cookie": f"sessionid={session_id}"})